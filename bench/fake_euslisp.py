@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""Stand-in for an euslisp process running slime-toplevel.l
+
+Speaks the same protocol to euslime: forms are read from stdin, their
+output is written to stdout followed by the end-of-eval token, and
+results are sent as socket-request frames, split into chunks when
+long. Side channel requests are answered on the toplevel connection
+and on the introspection connection, from a thread as the real one.
+
+Only the replies needed by euslime are simulated. The behaviour is set
+with environment variables:
+
+  FAKE_EUSLISP_STARTUP    seconds to sleep before connecting
+  FAKE_EUSLISP_DELAY      seconds taken by each side channel request
+  FAKE_EUSLISP_SYMBOLS    number of symbols in the USER package
+  FAKE_EUSLISP_NO_THREAD  if set, there is no introspection thread
+  FAKE_EUSLISP_COMPILE    seconds taken by compiler:compile-file
+
+With --attach ADDRESS, it stands for a running program which called
+slime-attach-server instead: it listens on ADDRESS, a port or a socket
+pathname, and serves each connection of euslime --attach from a thread,
+the connection taking the place of stdin and stdout.
+
+and the following forms can be evaluated:
+
+  (print-lines N WIDTH)   prints N lines of WIDTH characters
+  (big-result N)          returns a string of about N bytes
+  (sleep SECONDS)         returns after SECONDS
+  (error MESSAGE)         signals an error
+
+Any other form is echoed and returned as is.
+"""
+
+import os
+import random
+import re
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+CHUNK_SIZE = 65536
+WORDS = ['robot', 'joint', 'angle', 'vector', 'make', 'send', 'list',
+         'link', 'coords', 'rotate', 'matrix', 'float', 'string', 'limb',
+         'end', 'point', 'target', 'move', 'inverse', 'kinematics']
+CALLSTACK = ('Call Stack (max depth: 10):\n'
+             '0: at (slime:print-callstack 14)\n'
+             '1: at slime:slime-error\n'
+             '2: at slime:slime-error\n'
+             '3: at (error "fake error")\n'
+             '4: at (user::fake-function)\n')
+REGEX_AUTODOC = re.compile(r'\(slime::autodoc-arglist "([^"]*)"')
+REGEX_COMPILE = re.compile(r'\(slime::compile-file-notes "([^"]*)" "([^"]*)"')
+# Calls reported by the fake compiler as undefined functions
+REGEX_UNDEFINED = re.compile(r'\((undefined-[^\s()]*)')
+
+
+def env(name, default, type=float):
+    return type(os.environ.get('FAKE_EUSLISP_' + name, default))
+
+
+def user_symbols(count):
+    rnd = random.Random(0)
+    names = set()
+    while len(names) < count:
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))]
+        names.add('-'.join(words + [str(len(names))]))
+    return sorted(names)
+
+
+def sexp_list(items):
+    return '(' + ' '.join(items) + ')'
+
+
+class FakeEuslisp(object):
+    def __init__(self, address, repl=None):
+        self.address = address
+        # Connection of an attached session, instead of stdin and stdout
+        self.repl = repl
+        self.out = repl.makefile('wb', 65536) if repl else sys.stdout
+        self.delay = env('DELAY', 0)
+        self.token = '{}euslime-token-{}'.format(chr(29), address)
+        self.symbols = user_symbols(env('SYMBOLS', 100, int))
+        self.replies = {
+            '(slime::implementation-version)': '"fake 1.0"',
+            '(pathname-name *program-name*)': '"fake"',
+            '(list (slime::implementation-version) '
+            '(pathname-name *program-name*))': '("fake 1.0" "fake")',
+            '(slime::slime-prompt)': '("USER" "fake")',
+            '(lisp:pwd)': '"/tmp/"',
+            '(slime::help-sources)': '("fake 1.0" nil)',
+            '(slime::help-entries)': 'nil',
+            '(slime::use-help-index)': 't',
+            '(slime::slime-package-state)': '("USER" nil ({} {}))'.format(
+                '(("LISP" "L") () 3 4 4 0)',
+                '(("USER") ("LISP") 0 {0} {0} 0)'.format(len(self.symbols))),
+            '(slime::slime-package-symbols "LISP")': sexp_list(
+                '("{}" t nil :function :not-documented)'.format(name)
+                for name in ['LIST', 'VECTOR', 'SEND', 'MAKE-LIST']),
+            '(slime::slime-package-symbols "USER")': sexp_list(
+                '("{}" nil nil :function :not-documented)'.format(
+                    name.upper())
+                for name in self.symbols),
+        }
+        self.stream = self.connect(address)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def connect(address):
+        if address.isdigit():
+            conn = socket.create_connection(('127.0.0.1', int(address)))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(address)
+        return conn
+
+    def socket_request(self, command, value, rid='nil', conn=None):
+        # Same framing as slime::socket-request
+        frames = []
+        start = 0
+        while len(value) - start > CHUNK_SIZE:
+            frames += ['(chunk {})'.format(rid),
+                       value[start:start + CHUNK_SIZE]]
+            start += CHUNK_SIZE
+        frames += ['({} {})'.format(command, rid), value[start:]]
+        data = ''.join('{:06x}{}'.format(len(f), f) for f in frames)
+        with self.lock:
+            (conn or self.stream).sendall(data)
+
+    def finish_output(self):
+        self.out.write(self.token)
+        self.out.flush()
+
+    def reply(self, form):
+        if self.delay:
+            time.sleep(self.delay)
+        if form in self.replies:
+            return self.replies[form]
+        m = REGEX_AUTODOC.match(form)
+        if m:
+            return '(nil ({} x y &optional z &key (verbose nil)))'.format(
+                m.group(1))
+        m = REGEX_COMPILE.match(form)
+        if m:
+            return self.compile_file(m.group(1), m.group(2))
+        return 'nil'
+
+    @staticmethod
+    def compile_file(path, directory):
+        """Writes an empty shared object, and a warning for each call
+        of a function named undefined-*"""
+        time.sleep(env('COMPILE', 0))
+        with open(path) as f:
+            calls = sorted(set(REGEX_UNDEFINED.findall(f.read())))
+        name = os.path.splitext(os.path.basename(path))[0]
+        open(os.path.join(directory, name + '.so'), 'w').close()
+        output = ['compiling file: {}'.format(path)] + [
+            ';; {} is assumed to be undefined function'.format(call)
+            for call in calls]
+        return '"{}"'.format('\n'.join(output))
+
+    def evaluate(self, line):
+        """Evaluates a form read by the toplevel"""
+        words = line[1:-1].split() if line.startswith('(') else [line]
+        if line == '(slime:slimetop)':
+            self.finish_output()
+            self.socket_request('abort', 'nil')
+            return
+        if words[0] == 'print-lines':
+            text = 'x' * int(words[2]) + '\n'
+            for _ in range(int(words[1])):
+                self.out.write(text)
+            result = 'nil'
+        elif words[0] == 'big-result':
+            result = '"{}"'.format(('y' * 99 + '\n') * (int(words[1]) / 100))
+        elif words[0] == 'sleep':
+            time.sleep(float(words[1]))
+            result = 'nil'
+        elif words[0] == 'error':
+            self.finish_output()
+            self.socket_request('error', '"fake error"')
+            return
+        else:
+            self.out.write('; {}\n'.format(line))
+            result = line or 'nil'
+        self.finish_output()
+        self.socket_request('result', result)
+
+    def side_request(self, line, conn=None):
+        rid, form = line.split(' ', 1)
+        if form.startswith('(slime:print-callstack'):
+            self.out.write(CALLSTACK)
+            self.finish_output()
+            self.socket_request('error', '"print-callstack"', rid)
+            self.socket_request('abort', 'nil')
+        elif form.startswith('(reset'):
+            # Back at the toplevel, reploop reports it as slimetop does
+            self.socket_request('abort', 'nil')
+        elif form.startswith('(slime::slime-connect-introspection'):
+            if os.environ.get('FAKE_EUSLISP_NO_THREAD'):
+                self.socket_request('result', 'nil', rid)
+                return
+            address = form[1:-1].split()[1].strip('"')
+            thread = threading.Thread(target=self.introspection_loop,
+                                      args=(self.connect(address),))
+            thread.daemon = True
+            thread.start()
+            self.socket_request('result', 't', rid)
+        else:
+            self.socket_request('result', self.reply(form), rid, conn)
+
+    def introspection_loop(self, conn):
+        for line in self.read_lines(conn):
+            self.side_request(line, conn)
+
+    @staticmethod
+    def split_lines(buf):
+        lines = buf.split('\n')
+        return lines[:-1], lines[-1]
+
+    def read_lines(self, conn):
+        buf = str()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            lines, buf = self.split_lines(buf + data)
+            for line in lines:
+                yield line
+
+    def run(self):
+        repl = self.repl or sys.stdin.fileno()
+        bufs = {repl: str(), self.stream: str()}
+        while True:
+            ready, _, _ = select.select([repl, self.stream], [], [])
+            for source in ready:
+                if source in (self.stream, self.repl):
+                    data = source.recv(65536)
+                else:
+                    data = os.read(source, 65536)
+                if not data:
+                    return
+                lines, bufs[source] = self.split_lines(bufs[source] + data)
+                for line in lines:
+                    if source is self.stream:
+                        self.side_request(line)
+                    else:
+                        self.evaluate(line.strip())
+
+    def attach(self):
+        """Serves a session of euslime --attach, as slimetop does"""
+        self.finish_output()
+        self.socket_request('abort', 'nil')
+        try:
+            self.run()
+        finally:
+            self.stream.close()
+            self.repl.close()
+
+
+def attach_session(conn):
+    # euslime first sends the address of its side channel
+    line = str()
+    while not line.endswith('\n'):
+        data = conn.recv(1)
+        if not data:
+            return
+        line += data
+    FakeEuslisp(line.strip().strip('"'), repl=conn).attach()
+
+
+def serve_attach(address):
+    """Stands for slime-attach-server, until killed"""
+    if address.isdigit():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', int(address)))
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    server.listen(5)
+    while True:
+        conn, _ = server.accept()
+        thread = threading.Thread(target=attach_session, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    address = None
+    attach = None
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        if arg.startswith('--port-'):
+            address = arg[7:]
+        elif arg.startswith('--socket-'):
+            address = arg[9:]
+        elif arg == '--attach' and i + 1 < len(args):
+            attach = args[i + 1]
+    # euslime follows each interrupt with (reset), which aborts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    time.sleep(env('STARTUP', 0))
+    if attach:
+        serve_attach(attach)
+    else:
+        FakeEuslisp(address).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Replays a swank session recorded with euslime --record
+
+Runs EuslimeServer in this process, with bench/fake_euslisp.py or the
+given euslisp program, and sends it the messages recorded from emacs
+with their original timing divided by --speed. A message is sent only
+once the replies which preceded it in the recording (:return, :debug
+and :read-string) have been received again, so that causality holds
+at any speed. Then reports:
+
+  the latency of each swank operation, next to the recorded one
+  the :return replies which differ from the recorded ones
+
+Replies only match when replaying against the backend which was
+recorded, e.g. a session recorded with bench/run.py --record:
+
+  python bench/run.py -n 100 --record session.gz
+  python bench/replay.py session.gz --speed 0
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict
+from itertools import izip
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from euslime.logger import set_log_level  # NOQA
+from euslime.record import FROM_EMACS, read_recording  # NOQA
+from euslime.sexp import loads  # NOQA
+from run import Session, SwankError, percentile  # NOQA
+
+# Replies the next message from emacs may depend on
+MILESTONES = ('(:return ', '(:debug ', '(:read-string ')
+# Operations whose replies vary between runs
+UNSTABLE = frozenset(['swank:connection-info'])
+# Seconds to wait for a milestone before sending anyway
+STALL_TIMEOUT = 30
+
+
+def request_info(payload):
+    """Returns the operation and id of an :emacs-rex message"""
+    if not payload.startswith('(:emacs-rex '):
+        return None, None
+    sexp = loads(payload.decode('utf-8'))
+    return sexp[1][0].value().lower(), sexp[-1]
+
+
+def return_id(payload):
+    if not payload.startswith('(:return '):
+        return None
+    return int(payload[payload.rindex(' ') + 1:-1])
+
+
+class Recording(object):
+    """Messages from emacs with the replies they wait for"""
+
+    def __init__(self, path):
+        self.sends = []  # (seconds, payload, milestones before)
+        self.operations = {}  # id -> operation
+        self.returns = {}  # id -> recorded :return payload
+        self.latency = defaultdict(list)
+        sent = {}
+        milestones = 0
+        for direction, seconds, payload in read_recording(path):
+            if direction == FROM_EMACS:
+                self.sends.append((seconds, payload, milestones))
+                op, rid = request_info(payload)
+                if op:
+                    self.operations[rid] = op
+                    sent[rid] = seconds
+                continue
+            if payload.startswith(MILESTONES):
+                milestones += 1
+            rid = return_id(payload)
+            if rid in sent:
+                self.returns[rid] = payload
+                self.latency[self.operations[rid]].append(
+                    seconds - sent.pop(rid))
+        self.milestones = milestones
+
+
+class Replayer(object):
+    def __init__(self, recording, session, speed):
+        self.recording = recording
+        self.session = session
+        self.speed = speed
+        self.cond = threading.Condition()
+        self.milestones = 0
+        self.closed = False
+        self.sent = {}
+        self.returns = {}
+        self.latency = defaultdict(list)
+        self.stalls = 0
+
+    def receive(self):
+        client = self.session.client
+        while True:
+            try:
+                payload = client.recv()
+            except (SwankError, socket.error):
+                break
+            now = time.time()
+            rid = return_id(payload)
+            with self.cond:
+                if rid in self.sent:
+                    self.returns[rid] = payload
+                    self.latency[self.recording.operations[rid]].append(
+                        now - self.sent.pop(rid))
+                if payload.startswith(MILESTONES):
+                    self.milestones += 1
+                    self.cond.notify_all()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def wait_milestones(self, count, timeout=STALL_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.milestones < count and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stalls += 1
+                    return
+                self.cond.wait(remaining)
+
+    def run(self):
+        thread = threading.Thread(target=self.receive)
+        thread.daemon = True
+        thread.start()
+        conn = self.session.client.socket
+        start = time.time()
+        for seconds, payload, milestones in self.recording.sends:
+            if self.speed > 0:
+                delay = start + seconds / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.wait_milestones(milestones)
+            if self.closed:
+                break
+            op, rid = request_info(payload)
+            with self.cond:
+                if op:
+                    self.sent[rid] = time.time()
+                conn.sendall('{:06x}{}'.format(len(payload), payload))
+        # Wait for the pending replies
+        self.wait_milestones(self.recording.milestones)
+        return time.time() - start
+
+    def differences(self):
+        diffs = []
+        for rid, payload in sorted(self.recording.returns.items()):
+            if self.recording.operations[rid] in UNSTABLE:
+                continue
+            replayed = self.returns.get(rid)
+            if replayed != payload:
+                diffs.append({'id': rid,
+                              'operation': self.recording.operations[rid],
+                              'recorded': payload, 'replayed': replayed})
+        return diffs
+
+
+def summary(times):
+    if not times:
+        return None
+    return {'p50_ms': percentile(times, 50) * 1e3,
+            'p99_ms': percentile(times, 99) * 1e3,
+            'count': len(times)}
+
+
+def excerpts(recorded, replayed, width=160):
+    """Returns both replies from a little before their first difference"""
+    replayed = replayed or 'nil'
+    pos = 0
+    for a, b in izip(recorded, replayed):
+        if a != b:
+            break
+        pos += 1
+    start = max(pos - 40, 0)
+    prefix = '...' if start else ''
+    return (prefix + recorded[start:start + width],
+            prefix + replayed[start:start + width])
+
+
+def report(results, max_diffs):
+    print('{:32} {:>6} {:>18} {:>18}'.format(
+        'operation (ms)', 'count', 'recorded p50/p99', 'replayed p50/p99'))
+    for op, res in sorted(results['operations'].items()):
+        rec, rep = res['recorded'], res['replayed']
+        print('{:32} {:6} {:>18} {:>18}'.format(
+            op, rec['count'],
+            '{:.2f}/{:.2f}'.format(rec['p50_ms'], rec['p99_ms']),
+            '{:.2f}/{:.2f}'.format(rep['p50_ms'], rep['p99_ms'])
+            if rep else 'no reply'))
+    print('\nreplayed {} messages in {:.2f} s ({:.2f} s recorded), '
+          '{} stalls'.format(results['messages'], results['elapsed_s'],
+                             results['recorded_s'], results['stalls']))
+    diffs = results['differences']
+    print('{} of {} replies differ'.format(len(diffs), results['replies']))
+    for diff in diffs[:max_diffs]:
+        recorded, replayed = excerpts(diff['recorded'], diff['replayed'])
+        print('\n#{} {}'.format(diff['id'], diff['operation']))
+        print('  recorded: {}'.format(recorded))
+        print('  replayed: {}'.format(replayed))
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("recording", help="File written by euslime --record")
+    p.add_argument("--speed", type=float, default=1,
+                   help="Replay speed factor (0 for no delays)")
+    p.add_argument("--program", type=str,
+                   help="Euslisp program (default: bench/fake_euslisp.py)")
+    p.add_argument("--init-file", type=str,
+                   help="Initialization file of the euslisp program")
+    p.add_argument("--symbols", type=int, default=10000,
+                   help="Symbols in the USER package of the fake backend")
+    p.add_argument("--diffs", type=int, default=5,
+                   help="Differing replies to print")
+    p.add_argument("--json", type=str,
+                   help="Also write the results to this file")
+    opts = p.parse_args()
+
+    set_log_level('error')
+    os.environ['FAKE_EUSLISP_SYMBOLS'] = str(opts.symbols)
+    server_args = {'output_budget': 0}
+    if opts.program:
+        server_args['program'] = opts.program
+    if opts.init_file:
+        server_args['loader'] = opts.init_file
+
+    recording = Recording(opts.recording)
+    session = Session(**server_args)
+    replayer = Replayer(recording, session, opts.speed)
+    elapsed = replayer.run()
+    try:
+        session.close()
+    except socket.error:
+        pass  # the recording ended with swank:quit-lisp
+
+    ops = set(recording.latency) | set(replayer.latency)
+    results = {
+        'operations': dict(
+            (op, {'recorded': summary(recording.latency[op]),
+                  'replayed': summary(replayer.latency[op])})
+            for op in ops if recording.latency[op]),
+        'messages': len(recording.sends),
+        'elapsed_s': elapsed,
+        'recorded_s': recording.sends[-1][0] if recording.sends else 0,
+        'stalls': replayer.stalls,
+        'replies': len(recording.returns),
+        'differences': replayer.differences(),
+    }
+    report(results, opts.diffs)
+    if opts.json:
+        results['options'] = vars(opts)
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
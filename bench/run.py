@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Benchmarks euslime against the fake euslisp backend
+
+Runs EuslimeServer in this process with bench/fake_euslisp.py as the
+euslisp program, connects to it as a swank client and reports:
+
+  startup      time from starting the server until the REPL is created,
+               the client connecting --connect-delay after the start
+  eval         latency of swank-repl:listener-eval
+  autodoc      latency of swank:autodoc on a different operator each time
+  completions  latency of swank:completions
+  fuzzy        latency of swank:fuzzy-completions
+  throughput   bytes of output per second of a print loop
+
+With --attach, the fake backend is started once as a running program
+and every session attaches to it, as euslime --attach does.
+
+Nothing but python and the euslime dependencies is needed, so results
+can be compared between commits:
+
+  python bench/run.py --symbols 100000 --json before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from euslime import stats  # NOQA
+from euslime.logger import set_log_level  # NOQA
+from euslime.server import EuslimeServer  # NOQA
+
+FAKE_EUSLISP = os.path.join(ROOT, 'bench', 'fake_euslisp.py')
+BUFSIZE = 65536
+
+
+class SwankError(Exception):
+    pass
+
+
+class SwankClient(object):
+    """Minimal swank client, answering nothing but :return"""
+
+    def __init__(self, port):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = str()
+        self.counter = 0
+        self.received = 0
+
+    def send(self, form, thread=':repl-thread'):
+        self.counter += 1
+        msg = '(:emacs-rex {} "USER" {} {})'.format(
+            form, thread, self.counter)
+        self.socket.sendall('{:06x}{}'.format(len(msg), msg))
+        return self.counter
+
+    def recv(self):
+        while True:
+            if len(self.buffer) >= 6:
+                length = int(self.buffer[:6], 16) + 6
+                if len(self.buffer) >= length:
+                    msg = self.buffer[6:length]
+                    self.buffer = self.buffer[length:]
+                    self.received += length
+                    return msg
+            data = self.socket.recv(BUFSIZE)
+            if not data:
+                raise SwankError('Connection closed')
+            self.buffer += data
+
+    def call(self, form, thread=':repl-thread'):
+        """Returns the :return message of form"""
+        end = ' {})'.format(self.send(form, thread))
+        while True:
+            msg = self.recv()
+            if msg.startswith('(:debug '):
+                raise SwankError(msg)
+            if msg.startswith('(:return ') and msg.endswith(end):
+                return msg
+
+    def close(self):
+        self.socket.close()
+
+
+class Session(object):
+    """Server and client of one benchmark run"""
+
+    def __init__(self, connect_delay=0, **kwargs):
+        kwargs.setdefault('program', FAKE_EUSLISP)
+        kwargs.setdefault('loader', 'fake-loader.l')
+        self.server = EuslimeServer(('127.0.0.1', 0), **kwargs)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        # Emacs reads the port file and connects some time later
+        time.sleep(connect_delay)
+        self.client = SwankClient(self.server.socket.getsockname()[1])
+
+    def start_repl(self):
+        self.client.call('(swank:connection-info)', 't')
+        self.client.call(
+            '(swank-repl:create-repl nil :coding-system "utf-8-unix")', 't')
+
+    def close(self):
+        self.client.send('(swank:quit-lisp)', 't')
+        self.thread.join(10)
+        self.server.server_close()
+        self.client.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def latency(func, args):
+    times = []
+    for arg in args:
+        start = time.time()
+        func(arg)
+        times.append(time.time() - start)
+    return {'p50_ms': percentile(times, 50) * 1e3,
+            'p99_ms': percentile(times, 99) * 1e3,
+            'count': len(times)}
+
+
+def start_attach_server():
+    """Starts the fake backend as a program serving euslime --attach"""
+    tmpdir = tempfile.mkdtemp(prefix='euslime-bench-')
+    address = os.path.join(tmpdir, 'attach')
+    program = subprocess.Popen([sys.executable, FAKE_EUSLISP,
+                                '--attach', address])
+    while not os.path.exists(address):
+        if program.poll() is not None:
+            raise RuntimeError('fake euslisp exited')
+        time.sleep(0.01)
+    return program, address, tmpdir
+
+
+def run(opts):
+    server_args = {'standby': opts.standby, 'unix_socket': opts.unix_socket,
+                   'output_budget': opts.output_budget << 20,
+                   'prestart': not opts.no_prestart}
+    if opts.attach:
+        program, server_args['attach'], tmpdir = start_attach_server()
+    try:
+        return run_sessions(opts, server_args)
+    finally:
+        if opts.attach:
+            program.kill()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_sessions(opts, server_args):
+    results = {}
+
+    times = []
+    for _ in range(opts.startups):
+        start = time.time()
+        session = Session(connect_delay=opts.connect_delay / 1000.0,
+                          **server_args)
+        session.start_repl()
+        times.append(time.time() - start)
+        session.close()
+    results['startup'] = {'p50_ms': percentile(times, 50) * 1e3,
+                          'max_ms': max(times) * 1e3,
+                          'count': len(times)}
+
+    session = Session(record=opts.record, **server_args)
+    session.start_repl()
+    client = session.client
+    rnd = random.Random(0)
+    n = opts.iterations
+
+    results['eval'] = latency(
+        lambda i: client.call(
+            '(swank-repl:listener-eval "(+ 1 {})\n")'.format(i)),
+        range(n))
+    results['autodoc'] = latency(
+        lambda i: client.call(
+            '(swank:autodoc (quote ("op-{}" "" swank::%cursor-marker%)) '
+            ':print-right-margin 80)'.format(i)),
+        range(n))
+    results['completions'] = latency(
+        lambda prefix: client.call(
+            '(swank:completions "{}" (quote "USER"))'.format(prefix)),
+        [rnd.choice(['ro', 'make-', 'joint-a', 'send', 'l'])
+         for _ in range(n)])
+    results['fuzzy'] = latency(
+        lambda key: client.call(
+            '(swank:fuzzy-completions "{}" "USER" :limit 300 '
+            ':time-limit-in-msec 1500)'.format(key)),
+        [rnd.choice(['mvl', 'rja', 'robot-joint-angle', 'ik'])
+         for _ in range(max(n / 10, 5))])
+
+    lines, width = opts.output_lines, opts.output_width
+    received = client.received
+    start = time.time()
+    client.call('(swank-repl:listener-eval "(print-lines {} {})\n")'.format(
+        lines, width))
+    elapsed = time.time() - start
+    results['throughput'] = {
+        'output_mb': lines * (width + 1) / 1e6,
+        'received_mb': (client.received - received) / 1e6,
+        'mb_per_s': lines * (width + 1) / 1e6 / elapsed,
+    }
+    session.close()
+    if stats.enabled:
+        results['server'] = stats.snapshot()
+    return results
+
+
+def report(results):
+    startup = results['startup']
+    print('startup      p50 {:8.1f} ms   max {:8.1f} ms   ({} runs)'.format(
+        startup['p50_ms'], startup['max_ms'], startup['count']))
+    for name in ['eval', 'autodoc', 'completions', 'fuzzy']:
+        res = results[name]
+        print('{:12} p50 {:8.2f} ms   p99 {:8.2f} ms   ({} requests)'.format(
+            name, res['p50_ms'], res['p99_ms'], res['count']))
+    res = results['throughput']
+    print('throughput   {:8.1f} MB/s   ({:.1f} MB printed, {:.1f} MB sent)'
+          .format(res['mb_per_s'], res['output_mb'], res['received_mb']))
+    if 'server' in results:
+        print('\nserver side (ms)                 count      p50      p99'
+              '  euslisp   python')
+        for name, res in sorted(results['server']['requests'].items()):
+            print('{:32} {:5} {:8.2f} {:8.2f} {:8.2f} {:8.2f}'.format(
+                name, res['count'], res['p50_ms'], res['p99_ms'],
+                res['euslisp_ms'], res['python_ms']))
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("--iterations", "-n", type=int, default=500,
+                   help="Requests per latency measurement")
+    p.add_argument("--startups", type=int, default=5,
+                   help="Server startups to measure")
+    p.add_argument("--symbols", type=int, default=10000,
+                   help="Symbols in the USER package of the fake backend")
+    p.add_argument("--delay", type=float, default=0,
+                   help="Milliseconds taken by the fake backend "
+                   "for each side channel request")
+    p.add_argument("--output-lines", type=int, default=200000)
+    p.add_argument("--output-width", type=int, default=80)
+    p.add_argument("--output-budget", type=int, default=0,
+                   help="Megabytes of output per evaluation "
+                   "(0 for no limit)")
+    p.add_argument("--standby", type=int, default=0)
+    p.add_argument("--unix-socket", action="store_true")
+    p.add_argument("--no-thread", action="store_true",
+                   help="Disable the introspection thread")
+    p.add_argument("--program-startup", type=float, default=0,
+                   help="Seconds taken by the fake backend to start")
+    p.add_argument("--connect-delay", type=float, default=0,
+                   help="Milliseconds between the start of the server "
+                   "and the connection of the client")
+    p.add_argument("--no-prestart", action="store_true",
+                   help="Start euslisp when the client connects")
+    p.add_argument("--attach", action="store_true",
+                   help="Attach every session to one running fake "
+                   "backend instead of starting one each")
+    p.add_argument("--record", type=str,
+                   help="Record the swank messages of the latency and "
+                   "throughput runs, for replay.py")
+    p.add_argument("--stats", action="store_true",
+                   help="Enable the server statistics and report them")
+    p.add_argument("--json", type=str,
+                   help="Also write the results to this file")
+    opts = p.parse_args()
+
+    set_log_level('error')
+    os.environ['FAKE_EUSLISP_SYMBOLS'] = str(opts.symbols)
+    os.environ['FAKE_EUSLISP_DELAY'] = str(opts.delay / 1000.0)
+    os.environ['FAKE_EUSLISP_STARTUP'] = str(opts.program_startup)
+    if opts.no_thread:
+        os.environ['FAKE_EUSLISP_NO_THREAD'] = '1'
+    if opts.stats:
+        stats.enable()
+
+    results = run(opts)
+    report(results)
+    if opts.json:
+        results['options'] = vars(opts)
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Correctness and throughput of the euslisp output scanner
+
+Checks OutputScanner against a corpus of random outputs (text, ANSI
+escape sequences, end-of-eval tokens and stray group separators), each
+fed to the scanner cut at random boundaries, with and without color.
+The text and tokens it returns must be those of the whole output
+scanned at once, whatever the cuts.
+
+Then measures the throughput of the scanner on a print loop, read in
+chunks of --read-sizes bytes, next to that of the previous approach:
+removing escape sequences from each chunk on its own and looking for
+the token in it, which misses those cut in two.
+
+Exits with status 1 if any output is scanned wrong.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from euslime.bridge import ESCAPE_LENGTH, OutputScanner  # NOQA
+
+TOKEN = '{}euslime-token-4015'.format(chr(29))
+ESCAPES = ['\x1b[0m', '\x1b[31m', '\x1b[1;32m', '\x1b[38;5;208m', '\x1b[m']
+WORDS = ['robot', 'joint', 'angle', ';;', '(send *ri* :angle-vector)',
+         'mm', '#f(0.0 1.0)', '\n']
+REGEX_ESCAPE = re.compile(r'\x1b[^m]{{0,{}}}m'.format(ESCAPE_LENGTH))
+# Same as the scanner before, for comparison
+REGEX_ANSI = re.compile(r'\x1b[^m]*m')
+
+
+def random_output(rnd, length):
+    pieces = []
+    while len(pieces) < length:
+        r = rnd.random()
+        if r < 0.1:
+            pieces.append(TOKEN)
+        elif r < 0.3:
+            pieces.append(rnd.choice(ESCAPES))
+        elif r < 0.32:
+            pieces.append(chr(29))
+        else:
+            pieces.append(rnd.choice(WORDS))
+    # Nothing unfinished is left at the end
+    pieces.append('\n')
+    return ''.join(pieces)
+
+
+def random_cuts(rnd, data, max_size):
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.randint(1, max_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def merge_text(pieces):
+    """Joins consecutive text pieces, which may be cut anywhere"""
+    merged = []
+    text = []
+    for piece in pieces:
+        if piece == TOKEN:
+            if text:
+                merged.append(''.join(text))
+                text = []
+            merged.append(piece)
+        else:
+            text.append(piece)
+    if text:
+        merged.append(''.join(text))
+    return merged
+
+
+def reference(data, color):
+    """Text and tokens of the whole output scanned at once"""
+    pieces = []
+    for num, text in enumerate(data.split(TOKEN)):
+        if num:
+            pieces.append(TOKEN)
+        pieces.append(text if color else REGEX_ESCAPE.sub('', text))
+    return merge_text([p for p in pieces if p])
+
+
+def scan(chunks, color):
+    """Text and tokens returned by OutputScanner, unmerged"""
+    scanner = OutputScanner(TOKEN, color)
+    pieces = []
+    for chunk in chunks:
+        pieces.extend(scanner.feed(chunk))
+    pieces.extend(scanner.flush())
+    return pieces
+
+
+def scan_per_chunk(chunks, color):
+    pieces = []
+    for chunk in chunks:
+        if not color:
+            chunk = REGEX_ANSI.sub('', chunk)
+        text = chunk.split(TOKEN)
+        for num, t in enumerate(text):
+            if num:
+                pieces.append(TOKEN)
+            if t:
+                pieces.append(t)
+    return pieces
+
+
+def check_corpus(opts):
+    rnd = random.Random(opts.seed)
+    wrong = 0
+    per_chunk = 0
+    for num in range(opts.outputs):
+        data = random_output(rnd, rnd.randint(1, opts.length))
+        chunks = random_cuts(rnd, data, opts.max_cut)
+        for color in (False, True):
+            expected = reference(data, color)
+            if merge_text(scan(chunks, color)) != expected:
+                wrong += 1
+                if wrong <= 3:
+                    print('       output {} (color {}) cut as {!r}'.format(
+                        num, color, chunks[:20]))
+            if merge_text(scan_per_chunk(chunks, color)) != expected:
+                per_chunk += 1
+    runs = opts.outputs * 2
+    print('{:6} {} of {} outputs scanned wrong'.format(
+        'ok' if not wrong else 'FAILED', wrong, runs))
+    print('       {} of {} wrong when scanning each chunk on its own'.format(
+        per_chunk, runs))
+    return not wrong
+
+
+def throughput(func, chunks, color, repeat):
+    size = sum(len(c) for c in chunks) * repeat
+    start = time.time()
+    for _ in range(repeat):
+        func(chunks, color)
+    return size / (time.time() - start) / 1e6
+
+
+def run_benchmark(opts):
+    line = 'x' * 79 + '\n'
+    colored = '\x1b[32m' + 'x' * 70 + '\x1b[0m\n'
+    print('\n{:24} {:>12} {:>12}'.format(
+        'output (MB/s)', 'scanner', 'per chunk'))
+    for name, text in (('plain', line), ('colored', colored)):
+        data = text * opts.lines + TOKEN
+        for read_size in opts.read_sizes:
+            chunks = [data[i:i + read_size]
+                      for i in range(0, len(data), read_size)]
+            for color in (False, True):
+                label = '{}, {} KB{}'.format(name, read_size / 1024,
+                                             ', color' if color else '')
+                print('{:24} {:12.0f} {:12.0f}'.format(
+                    label,
+                    throughput(scan, chunks, color, opts.repeat),
+                    throughput(scan_per_chunk, chunks, color, opts.repeat)))
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("--outputs", type=int, default=20000,
+                   help="Random outputs of the corpus")
+    p.add_argument("--length", type=int, default=60,
+                   help="Maximum pieces of each random output")
+    p.add_argument("--max-cut", type=int, default=40,
+                   help="Maximum bytes between two random cuts")
+    p.add_argument("--seed", type=int, default=0,
+                   help="Seed of the corpus")
+    p.add_argument("--lines", type=int, default=200000,
+                   help="Lines of output of the throughput benchmark")
+    p.add_argument("--read-sizes", type=int, nargs='+',
+                   default=[4096, 65536],
+                   help="Bytes per read of the throughput benchmark")
+    p.add_argument("--repeat", type=int, default=3,
+                   help="Runs of each throughput measurement")
+    opts = p.parse_args()
+
+    ok = check_corpus(opts)
+    if opts.lines:
+        run_benchmark(opts)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Stress test of a multi-session EuslimeServer
+
+Runs EuslimeServer with multi_session in this process, with
+bench/fake_euslisp.py as the euslisp program, opens --sessions
+concurrent connections which all evaluate, ask for autodoc and
+completions at once, and checks that:
+
+  every session gets its own euslisp process
+  every evaluation replies with its own session's output and result
+  a connection beyond the maximum number of sessions is refused
+  a session still answers after many resets of its toplevel
+  idle sessions are closed after --timeout seconds
+
+Exits with status 1 if any check fails.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from euslime.logger import set_log_level  # NOQA
+from euslime.server import EuslimeServer  # NOQA
+from run import FAKE_EUSLISP, SwankClient, SwankError, percentile  # NOQA
+
+
+class Client(threading.Thread):
+    """Session of one simulated emacs"""
+
+    def __init__(self, num, port, opts, connected, go):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.num = num
+        self.port = port
+        self.opts = opts
+        self.connected = connected
+        self.go = go
+        self.latency = defaultdict(list)
+        self.errors = []
+        self.client = None
+
+    def timed(self, op, form, thread=':repl-thread'):
+        start = time.time()
+        messages = self.call(form, thread)
+        self.latency[op].append(time.time() - start)
+        return messages
+
+    def call(self, form, thread):
+        """Returns the messages received until the :return of form"""
+        end = ' {})'.format(self.client.send(form, thread))
+        messages = []
+        while True:
+            msg = self.client.recv()
+            messages.append(msg)
+            if msg.startswith('(:return ') and msg.endswith(end):
+                return messages
+
+    def run(self):
+        try:
+            self.client = SwankClient(self.port)
+            self.timed('connection-info', '(swank:connection-info)', 't')
+            self.timed('create-repl', '(swank-repl:create-repl nil '
+                       ':coding-system "utf-8-unix")', 't')
+        except (SwankError, socket.error) as e:
+            self.errors.append('connect: {}'.format(e))
+            return
+        finally:
+            self.connected.release()
+        self.go.wait()
+        try:
+            for i in range(self.opts.iterations):
+                self.check_eval(i)
+                self.timed('autodoc', '(swank:autodoc (quote ("op-{}" "" '
+                           'swank::%cursor-marker%)) :print-right-margin 80)'
+                           .format(i))
+                prefix = ['ro', 'make-', 'l'][i % 3]
+                self.timed('completions', '(swank:completions "{}" '
+                           '(quote "USER"))'.format(prefix))
+        except (SwankError, socket.error) as e:
+            self.errors.append('requests: {}'.format(e))
+
+    def check_eval(self, i):
+        form = '(session-{}-{})'.format(self.num, i)
+        messages = self.timed(
+            'eval', '(swank-repl:listener-eval "{}\n")'.format(form))
+        output = '(:write-string "; {}\n")'.format(form)
+        result = '(:write-string "{}" :repl-result)'.format(form)
+        if output not in messages or result not in messages:
+            self.errors.append('eval {}: unexpected replies {}'.format(
+                form, messages))
+        elif [m for m in messages if 'session-' in m and form not in m]:
+            self.errors.append('eval {}: output of another session'.format(
+                form))
+
+    def wait_closed(self, timeout):
+        """Returns True if the server closes the connection in time"""
+        self.client.socket.settimeout(timeout)
+        try:
+            while self.client.socket.recv(65536):
+                pass
+        except socket.timeout:
+            return False
+        except socket.error:
+            pass
+        return True
+
+
+def check(ok, what, failures):
+    print('{:6} {}'.format('ok' if ok else 'FAILED', what))
+    if not ok:
+        failures.append(what)
+
+
+def answers_after_resets(server, client, resets):
+    """Returns True if client's session still evaluates requests on the
+    toplevel connection after its toplevel was reset resets times, each
+    reset leaving an abort reply nobody waits for"""
+    port = client.client.socket.getsockname()[1]
+    with server.lock:
+        handler = next(h for h in server.sessions
+                       if h.client_address[1] == port)
+    for _ in range(resets):
+        handler.swank.handler.euslisp.reset()
+    client.client.socket.settimeout(5)
+    try:
+        client.call('(swank:set-package "USER")', ':repl-thread')
+    except socket.timeout:
+        return False
+    finally:
+        client.client.socket.settimeout(None)
+    return True
+
+
+def run(opts):
+    server = EuslimeServer(('127.0.0.1', 0), program=FAKE_EUSLISP,
+                           loader='fake-loader.l', output_budget=0,
+                           multi_session=True, max_sessions=opts.sessions,
+                           session_timeout=opts.timeout)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.socket.getsockname()[1]
+    failures = []
+
+    connected = threading.Semaphore(0)
+    go = threading.Event()
+    clients = [Client(n, port, opts, connected, go)
+               for n in range(opts.sessions)]
+    start = time.time()
+    for c in clients:
+        c.start()
+    for _ in clients:
+        connected.acquire()
+    startup = time.time() - start
+    with server.lock:
+        pids = set(h.swank.handler.euslisp.process.pid
+                   for h in server.sessions)
+    check(len(pids) == opts.sessions,
+          '{} sessions with {} euslisp processes'.format(
+              opts.sessions, len(pids)), failures)
+
+    extra = SwankClient(port)
+    extra.send('(swank:connection-info)', 't')
+    try:
+        extra.recv()
+        refused = False
+    except (SwankError, socket.error):
+        refused = True
+    extra.close()
+    check(refused, 'connection beyond the maximum refused', failures)
+
+    start = time.time()
+    go.set()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+    errors = [e for c in clients for e in c.errors]
+    for e in errors[:5]:
+        print('       {}'.format(e[:300]))
+    check(not errors, '{} errors'.format(len(errors)), failures)
+
+    latency = defaultdict(list)
+    for c in clients:
+        for op, times in c.latency.items():
+            latency[op].extend(times)
+    requests = sum(len(latency[op]) for op in
+                   ['eval', 'autodoc', 'completions'])
+    print('\n{} sessions started in {:.2f} s'.format(opts.sessions, startup))
+    print('{} requests in {:.2f} s, {:.0f} requests/s'.format(
+        requests, elapsed, requests / elapsed))
+    for op in ['eval', 'autodoc', 'completions']:
+        times = latency[op]
+        if times:
+            print('{:12} p50 {:8.2f} ms   p99 {:8.2f} ms'.format(
+                op, percentile(times, 50) * 1e3, percentile(times, 99) * 1e3))
+    print()
+
+    check(answers_after_resets(server, clients[0], opts.resets),
+          'session answers after {} resets'.format(opts.resets), failures)
+
+    deadline = opts.timeout * 2 + 5
+    closed = all(c.wait_closed(deadline) for c in clients if c.client)
+    time.sleep(0.5)
+    with server.lock:
+        remaining = len(server.sessions)
+    check(closed and remaining == 0,
+          'idle sessions closed after {} s ({} left)'.format(
+              opts.timeout, remaining), failures)
+    alive = [pid for pid in pids if os.path.exists('/proc/{}'.format(pid))]
+    check(not alive, 'euslisp processes stopped ({} left)'.format(
+        len(alive)), failures)
+
+    server.shutdown()
+    server.server_close()
+    return failures
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("--sessions", type=int, default=24,
+                   help="Concurrent sessions, also the maximum allowed")
+    p.add_argument("--iterations", "-n", type=int, default=50,
+                   help="Evaluations, autodocs and completions per session")
+    p.add_argument("--symbols", type=int, default=2000,
+                   help="Symbols in the USER package of the fake backend")
+    p.add_argument("--resets", type=int, default=40,
+                   help="Resets of a toplevel before it must still answer")
+    p.add_argument("--timeout", type=float, default=2,
+                   help="Idle timeout of the sessions in seconds")
+    opts = p.parse_args()
+
+    set_log_level('error')
+    os.environ['FAKE_EUSLISP_SYMBOLS'] = str(opts.symbols)
+    failures = run(opts)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,10 @@
 (defvar euslime-port 0 ;; Let the OS pick an available port
   "Port number to use for communicating to the swank server.")
 
+(defvar euslime-attach-address nil
+  "Port or socket pathname of the running program to attach to, if any.
+Set by `euslime-attach'.")
+
 ;; Start EusLisp mode
 (add-hook 'slime-repl-mode-hook
           (lambda ()
@@ -143,18 +147,29 @@
 
 (defun euslime-init (file _)
   (setq slime-protocol-version 'ignore)
-  (format "--euslisp-program %s --init-file %s --port %s --port-filename %s %s\n"
+  (format "--euslisp-program %s --init-file %s --port %s --port-filename %s %s %s\n"
           inferior-euslisp-program
           (expand-file-name "slime-loader.l" euslime-compile-path)
           euslime-port
           file
-          (if (member 'slime-repl-ansi-color slime-contribs) "--color" "")))
+          (if (member 'slime-repl-ansi-color slime-contribs) "--color" "")
+          (if euslime-attach-address
+              (format "--attach %s" euslime-attach-address) "")))
 
 (defun euslime ()
   "euslime"
   (interactive)
+  (setq euslime-attach-address nil)
+  (euslime-prepare-files)
+  (euslime-prepare-tags)
+  (slime 'euslisp))
+
+(defun euslime-attach (address)
+  "euslime on a running program which called `slime:slime-attach-server'"
+  (interactive "sAttach to Euslisp on port or socket: ")
   (euslime-prepare-files)
   (euslime-prepare-tags)
+  (setq euslime-attach-address address)
   (slime 'euslisp))
 
 (provide 'euslime)
@@ -1,24 +1,46 @@
 from __future__ import print_function
 
+import errno
 import os
 import re
+import select
+import shutil
 import signal
 import socket
 import subprocess
 import sys
+import tempfile
 import time
 import traceback
-from threading import Lock, Thread
+from collections import deque
+from itertools import count
+from threading import Condition, Event, Lock, Thread, current_thread
 from Queue import Queue, Empty
-from sexpdata import loads, Symbol
-from euslime.logger import get_logger
+from sexpdata import Symbol
+from euslime import stats
+from euslime.logger import get_logger, trace
+from euslime.sexp import loads
 
 log = get_logger(__name__)
 IS_POSIX = 'posix' in sys.builtin_module_names
 HEADER_LENGTH = 6
 BUFSIZE = 1
-BUFLENGTH = 7000
-EXEC_RATE = 0.005
+BUFLENGTH = 65536
+SOCKET_BUFLENGTH = 65536
+# Output is sent to emacs once this many bytes are collected,
+# or after this many seconds while euslisp keeps printing
+FLUSH_SIZE = 65536
+FLUSH_INTERVAL = 0.02
+# Bytes of output held in memory before reading from euslisp is paused
+OUTPUT_CAPACITY = 1 << 20
+# Bytes of output per evaluation sent to emacs, the rest is elided
+OUTPUT_BUDGET = 8 << 20
+# Seconds between checks of paused streams
+PAUSE_INTERVAL = 0.01
+# Longest ANSI escape sequence removed from the output
+ESCAPE_LENGTH = 32
+# Result chunks held in memory before reading from euslisp is paused
+CHUNK_BACKLOG = 16
 DELIM = os.linesep
 REGEX_ANSI = re.compile(r'\x1b[^m]*m')
 
@@ -31,18 +53,315 @@ def no_color(msg):
     return REGEX_ANSI.sub(str(), msg)
 
 
+def resident_memory(pid):
+    """Returns the resident set size of pid in kB, or None if unknown"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def split_frames(buf):
+    """Splits buf into complete (6-digit hex length + payload) frames.
+
+    Returns the list of payloads and the remaining partial data."""
+    frames = []
+    pos = 0
+    while len(buf) - pos >= HEADER_LENGTH:
+        end = pos + HEADER_LENGTH + int(buf[pos:pos + HEADER_LENGTH], 16)
+        if len(buf) < end:
+            break
+        frames.append(buf[pos + HEADER_LENGTH:end])
+        pos = end
+    return frames, buf[pos:]
+
+
+def clear_queue(queue):
+    """Discards all pending items of queue, preserving EOF markers."""
+    items = []
+    try:
+        while True:
+            items.append(queue.get_nowait())
+    except Empty:
+        pass
+    if None in items:
+        queue.put(None)
+    return [x for x in items if x is not None]
+
+
+class OutputScanner(object):
+    """Splits euslisp output at the end-of-eval token.
+
+    Unless color is set, ANSI escape sequences are removed in the same
+    pass. Output is read from a pipe in arbitrary chunks, so the token
+    or an escape sequence may span two of them: the unfinished end of
+    a chunk is held back until the next one completes it.
+    """
+
+    def __init__(self, token, color=False):
+        self.token = token
+        self.color = color
+        self.escape = re.compile(r'\x1b[^m]{{0,{}}}m'.format(ESCAPE_LENGTH))
+        # Bytes of the next chunk which complete anything held back
+        self.lookahead = max(len(token), ESCAPE_LENGTH + 2)
+        self.rest = str()
+
+    def feed(self, data):
+        """Returns the text of data and the tokens found, in order"""
+        token = self.token
+        pieces = []
+        start = 0
+        pos = None
+        if self.rest:
+            # Only what was held back and the head of data which
+            # completes it are copied, the rest is scanned in place
+            head = self.rest + data[:self.lookahead]
+            end = self._incomplete(head, 0)
+            self._scan(head, 0, end, pieces)
+            if len(data) <= self.lookahead:
+                self.rest = head[end:]
+                return pieces
+            start = end - len(self.rest)
+        else:
+            pos = data.find(token)
+            # A token cut at the end of data starts in its last
+            # len(token) - 1 bytes, or anywhere in shorter data
+            if pos < 0 and (self.color or '\x1b' not in data) and \
+                    data.find(token[0], 1 - len(token)) < 0:
+                # Most chunks hold neither, and are returned as they are
+                return [data] if data else []
+        end = max(self._incomplete(data, start), start)
+        self.rest = data[end:] if end < len(data) else str()
+        self._scan(data, start, end, pieces, pos)
+        return pieces
+
+    def flush(self):
+        pieces = [self.rest] if self.rest else []
+        self.rest = str()
+        return pieces
+
+    def _scan(self, data, start, end, pieces, pos=None):
+        # Appends the text and tokens of data[start:end] to pieces,
+        # pos being -1 if data holds no token
+        if pos is None or pos >= 0:
+            pos = data.find(self.token, start, end)
+        while pos >= 0:
+            self._text(data, start, pos, pieces)
+            pieces.append(self.token)
+            start = pos + len(self.token)
+            pos = data.find(self.token, start, end)
+        self._text(data, start, end, pieces)
+
+    def _text(self, data, start, end, pieces):
+        # Appends the text of data[start:end], if any. Whole chunks are
+        # not copied
+        if start or end < len(data):
+            data = data[start:end]
+        if not self.color and '\x1b' in data:
+            data = self.escape.sub(str(), data)
+        if data:
+            pieces.append(data)
+
+    def _incomplete(self, data, start):
+        # Position of the unfinished token or escape sequence, if any,
+        # after start
+        end = len(data)
+        i = data.find(self.token[0], max(end - len(self.token) + 1, start))
+        while i >= 0:
+            if self.token.startswith(data[i:]):
+                end = i
+                break
+            i = data.find(self.token[0], i + 1)
+        if not self.color:
+            low = max(len(data) - ESCAPE_LENGTH - 1, start)
+            i = data.find('\x1b', max(low, data.rfind('m', low) + 1))
+            if i >= 0:
+                end = min(end, i)
+        return end
+
+
+def format_count(num, units):
+    for unit in units[:-1]:
+        if num < 1000:
+            break
+        num /= 1000.0
+    else:
+        unit = units[-1]
+    if isinstance(num, float):
+        return '{:.1f}{}'.format(num, unit)
+    return '{}{}'.format(num, unit)
+
+
+class OutputBuffer(object):
+    """Bounded buffer of euslisp output, with the interface of Queue.
+
+    At most budget bytes are delivered per evaluation, the rest is
+    counted and optionally spilled to a temporary file, then replaced
+    by a summary placed before the end-of-eval token, which is expected
+    as a chunk of its own as returned by OutputScanner. While an
+    evaluation is running, full() tells the reader to stop reading
+    until the consumer catches up. Between evaluations nobody consumes
+    the output, so the oldest chunks are dropped instead.
+    """
+
+    def __init__(self, token, capacity=None, budget=None, spill=False):
+        self.token = token
+        self.capacity = capacity or OUTPUT_CAPACITY
+        self.budget = OUTPUT_BUDGET if budget is None else budget
+        self.spill = spill
+        self.chunks = deque()
+        self.size = 0
+        self.consuming = False
+        self.cond = Condition(Lock())
+        self._reset()
+
+    def _reset(self):
+        self.delivered = 0
+        self.elided_bytes = 0
+        self.elided_lines = 0
+        self.spill_file = None
+
+    def begin(self):
+        """Starts a new evaluation, discarding pending output"""
+        with self.cond:
+            eof = None in self.chunks
+            self.chunks.clear()
+            self.size = 0
+            if eof:
+                self.chunks.append(None)
+            self._close_spill()
+            self._reset()
+            self.consuming = True
+
+    def end(self):
+        with self.cond:
+            self.consuming = False
+            self._close_spill()
+
+    def save(self):
+        """Sets the pending output and budget of the running evaluation
+        aside, as begin() does without discarding them, and returns
+        them for restore()"""
+        with self.cond:
+            eof = None in self.chunks
+            state = ([x for x in self.chunks if x is not None], self.size,
+                     self.consuming, self.delivered, self.elided_bytes,
+                     self.elided_lines, self.spill_file)
+            self.chunks.clear()
+            self.size = 0
+            if eof:
+                self.chunks.append(None)
+            self._reset()
+            self.consuming = True
+            return state
+
+    def restore(self, state):
+        """Puts back what save() set aside, before any output since"""
+        with self.cond:
+            chunks, size, self.consuming, self.delivered, \
+                self.elided_bytes, self.elided_lines, spill_file = state
+            self._close_spill()
+            self.spill_file = spill_file
+            self.chunks.extendleft(reversed(chunks))
+            self.size += size
+            self.cond.notify()
+
+    def full(self):
+        return self.consuming and self.size >= self.capacity
+
+    def put(self, data):
+        """Adds data, or None at EOF. Returns False if data was elided"""
+        with self.cond:
+            if data == self.token:
+                if self.elided_bytes:
+                    self._append(self._summary())
+            elif data is not None and self.budget:
+                if self.delivered + len(data) > self.budget:
+                    data = self._elide(data)
+                    if not data:
+                        return False
+            self._append(data)
+            self.cond.notify()
+            return True
+
+    def _append(self, data):
+        self.chunks.append(data)
+        if data is not None:
+            self.size += len(data)
+            self.delivered += len(data)
+            while not self.consuming and self.size > self.capacity:
+                self.size -= len(self.chunks.popleft())
+
+    def _elide(self, data):
+        # Returns the part of data within the budget
+        keep = 0
+        if not self.elided_bytes:
+            keep = max(self.budget - self.delivered, 0)
+            # Cut at the end of a line, if any
+            keep = data.rfind('\n', 0, keep) + 1 or keep
+        self.elided_bytes += len(data) - keep
+        self.elided_lines += data.count('\n', keep)
+        if self.spill:
+            if self.spill_file is None:
+                self.spill_file = tempfile.NamedTemporaryFile(
+                    prefix='euslime-output-', suffix='.log', delete=False)
+            self.spill_file.write(data[keep:])
+        return data[:keep]
+
+    def _summary(self):
+        msg = '\n... {} / {} lines suppressed'.format(
+            format_count(self.elided_bytes, ['B', 'KB', 'MB', 'GB']),
+            format_count(self.elided_lines, ['', 'k', 'M', 'G']))
+        if self.spill_file:
+            msg += ', saved to {}'.format(self.spill_file.name)
+            self._close_spill()
+        self.elided_bytes = self.elided_lines = 0
+        return msg + ' ...\n'
+
+    def _close_spill(self):
+        if self.spill_file:
+            self.spill_file.close()
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if block and timeout is None:
+                while not self.chunks:
+                    self.cond.wait()
+            elif block and not self.chunks:
+                self.cond.wait(timeout)
+            if not self.chunks:
+                raise Empty
+            data = self.chunks.popleft()
+            if data is not None:
+                self.size -= len(data)
+            return data
+
+    def get_nowait(self):
+        return self.get(False)
+
+
 class Process(object):
     def __init__(self, cmd,
                  on_output=None,
                  bufsize=None,
-                 delim=None,):
+                 delim=None,
+                 cpu_limit=None):
         self.cmd = cmd
+        # Seconds of CPU time after which the process gets SIGXCPU
+        self.cpu_limit = cpu_limit
         self.on_output = on_output or self.default_print_callback
         self.bufsize = bufsize or BUFSIZE
         self.delim = delim or DELIM
         self.lock = Lock()
         self.process = None
+        self.stdout_fd = None
         self.threads = None
+        # file descriptor -> callback, watched by the I/O thread
+        self.readers = {}
 
     def start(self):
         slime_env = os.environ.copy()
@@ -50,9 +369,10 @@ class Process(object):
         # as explained in section 8 of http://wiki.ros.org/rosconsole
         slime_env['ROSCONSOLE_STDOUT_LINE_BUFFERED'] = '1'
 
-        log.debug("Starting process with command %s" % self.cmd)
+        cmd = self.command()
+        log.debug("Starting process with command %s" % cmd)
         self.process = subprocess.Popen(
-            self.cmd,
+            cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             stdin=subprocess.PIPE,
@@ -61,45 +381,100 @@ class Process(object):
             env=slime_env,
         )
 
+        self.stdout_fd = self.process.stdout.fileno()
+        self.readers[self.stdout_fd] = self._read_stdout
+        self._start_io_thread()
+
+    def _start_io_thread(self):
         self.threads = [
-            Thread(target=self._get_stream_thread,
-                   args=("stdout", self.process.stdout, self.on_output)),
-            # Thread(target=self._get_stream_thread,
-            #        args=("stderr", self.process.stderr, self.on_output)),
+            Thread(target=self._io_thread),
         ]
         for t in self.threads:
             t.daemon = True
             t.start()
 
+    def command(self):
+        if not self.cpu_limit or not IS_POSIX:
+            return self.cmd
+        # Set by a shell rather than in a preexec_fn, which may deadlock
+        # the child of a multithreaded process. exec keeps the pid, and
+        # the process is killed 5 s after SIGXCPU
+        limit = int(self.cpu_limit)
+        return ['/bin/sh', '-c',
+                'ulimit -S -t {} && ulimit -H -t {} && exec "$@"'.format(
+                    limit, limit + 5),
+                self.cmd[0]] + list(self.cmd)
+
     def stop(self):
         if self.process.poll() is None:
             try:
+                # stdout is drained and closed by the I/O thread
                 self.process.terminate()
-                self.process.communicate()
+                self.process.wait()
             except Exception as e:
                 log.warn("failed to terminate: %s" % e)
 
+    def running(self):
+        return self.process.poll() is None
+
+    def interrupt(self):
+        self.process.send_signal(signal.SIGINT)
+
     def reset(self):
-        self.euslime_connection.send("(reset)" + self.delim)
+        self.channel.send("(reset)", reply=False)
 
     def ping(self):
         log.debug("Ping...")
         self.input(self.delim)
         log.debug("...Pong")
 
-    def _get_stream_thread(self, name, stream, callback):
-        while self.process.poll() is None:
+    def paused(self):
+        """File descriptors which must not be read for now"""
+        return []
+
+    def _io_thread(self):
+        # Block until one of the watched streams becomes readable,
+        # so that no time is spent sleeping between polls
+        while self.readers:
+            paused = self.paused()
+            fds = [fd for fd in self.readers if fd not in paused]
             try:
-                buf = os.read(stream.fileno(), self.buflen)
-                callback(buf)
-                if len(buf) < self.buflen * 0.8:
-                    time.sleep(self.rate)
-            except Exception:
-                log.error(traceback.format_exc())
-        else:
-            log.debug("Thread %s is dead" % name)
+                ready, _, _ = select.select(
+                    fds, [], [], PAUSE_INTERVAL if paused else None)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                callback = self.readers.get(fd)
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception:
+                    log.error(traceback.format_exc())
+                    del self.readers[fd]
+        log.debug("I/O thread is dead")
+
+    def _read_stdout(self):
+        buf = os.read(self.stdout_fd, self.buflen)
+        if buf:
+            self.on_output(buf)
+            return
+        # EOF on stdout means that the process is gone
+        del self.readers[self.stdout_fd]
+        self.exited()
+        self.on_close()
+
+    def exited(self):
+        self.process.wait()
+        log.debug("Process exited with code %s" % self.process.returncode)
+
+    def on_close(self):
+        pass
 
     def check_poll(self):
+        stats.count('check_poll')
         if self.process.poll() is not None:
             signum = abs(self.process.returncode)
             msg = "Process exited with code {0} ({1})".format(
@@ -110,10 +485,128 @@ class Process(object):
         cmd = cmd.strip().encode('utf-8')
         if not cmd.endswith(self.delim):
             cmd += self.delim
-        self.process.stdin.write(cmd)
+        try:
+            self.write(cmd)
+        except IOError:
+            # Report how the process died rather than the broken pipe
+            self.check_poll()
+            raise
+
+    def write(self, data):
+        self.process.stdin.write(data)
         self.process.stdin.flush()
 
 
+class SocketChannel(object):
+    """Socket connection to euslisp, with replies routed by request id.
+
+    Requests are sent as `id form' and each reply consists of a
+    (command id) frame followed by the value frame. Long values are
+    split, each part but the last one following a (chunk id) frame.
+    Replies without id come from the toplevel itself and are queued in
+    order to output, chunks included.
+    """
+
+    def __init__(self, connection, delim=None, serial=False):
+        self.connection = connection
+        self.delim = delim or DELIM
+        self.output = Queue()
+        self.pending = {}
+        self.counter = count(1)
+        self.lock = Lock()
+        # The toplevel evaluates one request per readable event,
+        # so requests on its connection must not be pipelined
+        self.serial = serial
+        self.busy = Lock()
+        self.closed = False
+        self.buffer = str()
+        self.header = None
+        # Chunk frames queued to output and not taken yet. Other replies
+        # without id, such as the abort which follows each reset, may be
+        # left in output when nobody waits for them
+        self.chunks = 0
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def send(self, cmd_str, reply=True):
+        """Sends cmd_str and returns the id to wait() for"""
+        if isinstance(cmd_str, unicode):
+            cmd_str = cmd_str.encode('utf-8')
+        with self.lock:
+            rid = next(self.counter) if reply else None
+            if rid:
+                self.pending[rid] = Queue()
+                if self.closed:
+                    self.pending[rid].put(None)
+            self.connection.sendall('{} {}{}'.format(
+                rid or 'nil', cmd_str, self.delim))
+        return rid
+
+    def wait(self, rid):
+        """Returns the (command value) reply to rid, or None on EOF"""
+        chunks = []
+        msg = self.pending[rid].get()
+        while msg and msg[0] == Symbol('chunk'):
+            chunks.append(msg[1])
+            msg = self.pending[rid].get()
+        with self.lock:
+            del self.pending[rid]
+        if msg and chunks:
+            chunks.append(msg[1])
+            msg = (msg[0], ''.join(chunks))
+        return msg
+
+    def request(self, cmd_str):
+        if not self.serial:
+            return self.wait(self.send(cmd_str))
+        with self.busy:
+            return self.wait(self.send(cmd_str))
+
+    def on_readable(self):
+        """Dispatches incoming replies. Returns False on EOF"""
+        msg = self.connection.recv(SOCKET_BUFLENGTH)
+        if not msg:
+            # recv() returns null string on EOF
+            self.close()
+            return False
+        frames, self.buffer = split_frames(self.buffer + msg)
+        for data in frames:
+            trace("Socket response: %s", data)
+            if self.header is None:
+                self.header = data
+                continue
+            command, rid = loads(self.header)
+            self.header = None
+            with self.lock:
+                if isinstance(rid, int):
+                    queue = self.pending.get(rid)
+                else:
+                    queue = self.output
+                if queue is self.output and command == Symbol('chunk'):
+                    self.chunks += 1
+            if queue is None:
+                log.warn("Ignore reply to unknown request %s" % rid)
+                continue
+            queue.put((command, data))
+        return True
+
+    def taken(self, msg):
+        """Called for each message taken from output"""
+        if msg and msg[0] == Symbol('chunk'):
+            with self.lock:
+                self.chunks -= 1
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for queue in self.pending.values():
+                queue.put(None)
+        self.output.put(None)
+
+
 class EuslispError(Exception):
     def __init__(self, message, stack=None, fatal=False):
         self.stack = stack
@@ -127,138 +620,273 @@ class EuslispResult(object):
 
 
 class EuslispProcess(Process):
-    def __init__(self, program=None, init_file=None, exec_rate=None,
-                 buflen=None, color=False):
+    def __init__(self, program=None, init_file=None, buflen=None,
+                 color=False, flush_size=None, flush_interval=None,
+                 output_budget=None, output_spill=False, unix_socket=False,
+                 cpu_limit=None):
         self.program = program
         self.init_file = init_file
 
-        self.socket = self._start_socket()
-        host, port = self.socket.getsockname()
-        self.token = '{}euslime-token-{}'.format(chr(29), port)
+        self.socket_dir = None
+        self.socket = self._start_socket(unix_socket)
+        if unix_socket:
+            self.address = self.socket.getsockname()
+            arg = "--socket-{}".format(self.address)
+        else:
+            host, self.address = self.socket.getsockname()
+            arg = "--port-{}".format(self.address)
+        self.token = '{}euslime-token-{}'.format(chr(29), self.address)
 
         super(EuslispProcess, self).__init__(
-            cmd=[self.program, self.init_file, "--port-{}".format(port)],
+            cmd=[self.program, self.init_file, arg],
             on_output=self.on_output,
+            cpu_limit=cpu_limit,
         )
 
         self.color = color  # Requires slime-repl-ansi-color
-        self.output = Queue()
-        self.rate = exec_rate or EXEC_RATE
+        self.scanner = OutputScanner(self.token, color)
+        self.output = OutputBuffer(self.token, budget=output_budget,
+                                   spill=output_spill)
         self.buflen = buflen or BUFLENGTH
+        self.flush_size = flush_size or FLUSH_SIZE
+        self.flush_interval = FLUSH_INTERVAL if flush_interval is None \
+            else flush_interval
+        self.last_flush = 0
+        self.channel = None
+        # Thread of eval() while it streams the output and result of
+        # the toplevel, notified on stream_end once it is done
+        self.streaming = None
+        self.stream_end = Condition(Lock())
+        self.connected = Event()
+        # Second connection served by a euslisp thread,
+        # which stays responsive during long evaluations
+        self.introspection_channel = None
+        self.introspection_connected = Event()
+        self.ready = False
+        self.readers[self.socket.fileno()] = self._accept_socket
 
     def start(self):
         super(EuslispProcess, self).start()
-        self.euslime_connection = self._socket_connect()
+        self.channel = self._socket_connect()
         self.input('(slime:slimetop)')
 
-    def _start_socket(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(("0.0.0.0", 0))
+    def _start_socket(self, unix_socket=False):
+        # Listen before euslisp starts, so that it connects at once
+        if unix_socket:
+            # Only reachable by the user, and without the TCP stack
+            self.socket_dir = tempfile.mkdtemp(prefix='euslime-')
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(os.path.join(self.socket_dir, 'socket'))
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(("127.0.0.1", 0))
         s.listen(5)
         return s
 
+    def _remove_socket(self):
+        self.socket.close()
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
     def _socket_connect(self):
-        host, port = self.socket.getsockname()
-        log.info("Connecting to euslime socket on %s:%s..." % (host, port))
-        conn, _ = self.socket.accept()
+        log.info("Connecting to euslime socket on %s..." % self.address)
+        self.connected.wait()
+        if self.channel is None:
+            self.check_poll()
         log.info("...Connected to euslime socket!")
-        return conn
+        return self.channel
+
+    def _accept_socket(self):
+        conn, _ = self.socket.accept()
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.channel is None:
+            self.channel = self._watch_socket(conn, serial=True)
+            self.connected.set()
+        else:
+            # The introspection thread connects after the toplevel
+            del self.readers[self.socket.fileno()]
+            self.introspection_channel = self._watch_socket(conn)
+            self.introspection_connected.set()
+
+    def _watch_socket(self, conn, serial=False):
+        channel = SocketChannel(conn, self.delim, serial=serial)
+
+        def read_socket():
+            if not channel.on_readable():
+                del self.readers[channel.fileno()]
+
+        self.readers[channel.fileno()] = read_socket
+        return channel
+
+    def paused(self):
+        # Back-pressure while emacs is slower than euslisp
+        fds = []
+        if self.output.full():
+            fds.append(self.stdout_fd)
+        # Chunks of an eval nobody consumes any more are left unpaused,
+        # to be discarded by the next one
+        if self.streaming and self.channel.chunks > CHUNK_BACKLOG:
+            fds.append(self.channel.fileno())
+        return fds
 
     def on_output(self, msg):
-        if not self.color:
-            msg = no_color(msg)
-        if msg:
-            log.debug("output: %s" % msg)
-            self.output.put(msg)
+        for piece in self.scanner.feed(msg):
+            if self.output.put(piece):
+                trace("output: %s", piece)
+
+    def on_close(self):
+        super(EuslispProcess, self).on_close()
+        self.readers.pop(self.socket.fileno(), None)
+        self._remove_socket()
+        self.connected.set()
+        self.introspection_connected.set()
+        for piece in self.scanner.flush():
+            self.output.put(piece)
+        self.output.put(None)
+        for channel in (self.channel, self.introspection_channel):
+            if channel:
+                channel.close()
+
+    def connection_closed(self):
+        self.check_poll()
+        raise EuslispError('Socket connection closed', fatal=True)
+
+    def _get(self, queue):
+        # Block until the I/O thread delivers data or reports EOF
+        start = stats.clock()
+        msg = queue.get()
+        stats.waited(start)
+        if msg is None:
+            queue.put(None)
+            self.connection_closed()
+        return msg
+
+    def _check_reply(self, reply):
+        if reply is None:
+            self.connection_closed()
+        trace('Socket request type: %s', reply[0])
+        return reply
 
     def clear_socket_stack(self):
-        try:
-            while True:
-                msg = self.euslime_connection.recv(1024, socket.MSG_DONTWAIT)
-                log.debug("Ignore msg: %s" % msg)
-        except socket.error:
-            return
+        for msg in clear_queue(self.channel.output):
+            self.channel.taken(msg)
+            trace("Ignore msg: %s %s", *msg)
 
-    def recv_socket_data(self):
-        def recv_data(hex_len):
-            if hex_len == str():
-                # recv() returns null string on EOF
-                raise EuslispError('Socket connection closed', fatal=True)
-            length = int(hex_len, 16)
-            while length > 0:
-                msg = self.euslime_connection.recv(length)
-                log.debug("Socket Response: %s" % msg)
-                length -= len(msg)
-                yield msg
-            return
-        log.debug('Waiting for socket data...')
+    def get_socket_response(self, recursive=False):
+        return ''.join(self.iter_socket_response(recursive)) or None
+
+    def iter_socket_response(self, recursive=False):
+        """Yields the result replied by the toplevel as it arrives"""
+        # Replies of the toplevel, which carry no request id
         while True:
-            try:
-                head_data = self.euslime_connection.recv(HEADER_LENGTH,
-                                                         socket.MSG_DONTWAIT)
-                break
-            except socket.error:
-                time.sleep(self.rate)
-                self.check_poll()
+            msg = self._get(self.channel.output)
+            self.channel.taken(msg)
+            command, value = self._check_reply(msg)
+            if command == Symbol('chunk'):
+                yield value
                 continue
-        return recv_data(head_data)
-
-    def get_socket_response(self, recursive=False):
-        def recv_next():
-            gen = self.recv_socket_data()
-            data = ''.join(list(gen))
-            return loads(data)
-        command = recv_next()
-        log.debug('Socket Request Type: %s' % command)
-        if command == Symbol('result'):
-            return self.recv_socket_data()
-        elif command == Symbol('error'):
-            if recursive:
+            if command == Symbol('result'):
+                yield value
                 return
-            msg = recv_next()
-            stack = self.get_callstack()
-            raise EuslispError(msg, stack)
-        elif command == Symbol('abort'):
-            return
-        raise Exception("Unhandled Socket Request Type: %s" % command)
+            elif command == Symbol('error'):
+                if recursive:
+                    return
+                stack = self.get_callstack()
+                raise EuslispError(loads(value), stack)
+            elif command == Symbol('abort'):
+                return
+            raise Exception("Unhandled Socket Request Type: %s" % command)
+
+    def get_output_batch(self):
+        """Returns the output queued so far, up to flush_size bytes.
+
+        When the previous batch was taken less than flush_interval ago,
+        euslisp is printing continuously and the output is collected
+        until flush_interval passes, so that a print loop results in
+        few large messages while a single print is sent right away.
+        The end-of-eval token, if any, is the last chunk returned."""
+        out = self._get(self.output)
+        chunks = [out]
+        size = len(out)
+        now = time.time()
+        if now - self.last_flush < self.flush_interval:
+            deadline = now + self.flush_interval
+        else:
+            deadline = now
+        start = stats.clock()
+        while size < self.flush_size and chunks[-1] != self.token:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    out = self.output.get(timeout=timeout)
+                else:
+                    out = self.output.get_nowait()
+            except Empty:
+                break
+            if out is None:
+                self.output.put(None)
+                break
+            chunks.append(out)
+            size += len(out)
+        stats.waited(start)
+        self.last_flush = time.time()
+        return chunks
 
     def get_output(self, recursive=False):
         while True:
-            try:
-                out = self.output.get(timeout=self.rate)
-                has_token = out.rsplit(self.token, 1)
-                if has_token[0]:
-                    yield has_token[0]
-                if len(has_token) >= 2 or not has_token[0]:
-                    # Check for Errors
-                    gen = self.get_socket_response(recursive=recursive)
-                    # Print Results
-                    # Do not use :repl-result presentation
-                    # to enable copy-paste of previous results,
-                    # which are signilized as swank objects otherwise
-                    # e.g. #.(swank:lookup-presented-object-or-lose 0.)
-                    if gen:
-                        # yield [Symbol(":presentation-start"), 0,
-                        #        Symbol(":repl-result")]
-                        for r in gen:
-                            # Colors are not allowed in :repl-result formatting
-                            yield [Symbol(":write-string"), no_color(r),
-                                   Symbol(":repl-result")]
-                        # yield [Symbol(":presentation-end"), 0,
-                        #        Symbol(":repl-result")]
-                        yield [Symbol(":write-string"), '\n',
+            chunks = self.get_output_batch()
+            done = chunks[-1] == self.token
+            if done:
+                chunks.pop()
+            if chunks:
+                yield ''.join(chunks)
+            if done:
+                # Check for Errors
+                res = self.iter_socket_response(recursive=recursive)
+                # Print Results
+                # Do not use :repl-result presentation
+                # to enable copy-paste of previous results,
+                # which are signilized as swank objects otherwise
+                # e.g. #.(swank:lookup-presented-object-or-lose 0.)
+                # Colors are not allowed in :repl-result formatting
+                scanner = OutputScanner(self.token)
+                printed = False
+                for chunk in res:
+                    # Long results are forwarded as they arrive
+                    for text in scanner.feed(chunk):
+                        printed = True
+                        yield [Symbol(":write-string"), text,
                                Symbol(":repl-result")]
-                    return
-            except Empty:
-                self.check_poll()
-                continue
+                for text in scanner.flush():
+                    printed = True
+                    yield [Symbol(":write-string"), text,
+                           Symbol(":repl-result")]
+                if printed:
+                    yield [Symbol(":write-string"), '\n',
+                           Symbol(":repl-result")]
+                return
 
     def get_callstack(self, end=10):
-        self.output = Queue()
+        # Output is not told apart, so wait for the evaluation of
+        # another thread to be consumed, unless called from that of
+        # this one, on an error
+        with self.stream_end:
+            while self.streaming not in (None, current_thread()):
+                self.stream_end.wait()
+        # The stack gets its own output budget
+        state = self.output.save()
         self.clear_socket_stack()
         cmd_str = '(slime:print-callstack {})'.format(end + 4)
-        self.euslime_connection.send(cmd_str + self.delim)
-        stack = list(self.get_output(recursive=True))
+        start = stats.clock()
+        try:
+            with self.channel.busy:
+                rid = self.channel.send(cmd_str)
+                stack = list(self.get_output(recursive=True))
+                self._check_reply(self.channel.wait(rid))  # the dummy error
+        finally:
+            self.output.restore(state)
+        stats.record('euslisp:callstack', start)
         stack = ''.join(stack)
         stack = [x.strip() for x in stack.split(self.delim)]
         # Remove 'Call Stack' and dummy error messages
@@ -275,25 +903,236 @@ class EuslispProcess(Process):
                     [i, split_line[1], [Symbol(":restartable"), False]])
             else:
                 break
-        self.euslime_connection.send('(reset *replevel*)' + self.delim)
+        self.channel.send('(reset *replevel*)', reply=False)
         return strace
 
     def exec_internal(self, cmd_str):
-        self.clear_socket_stack()
-        log.info('exec_internal: %s' % cmd_str)
-        self.euslime_connection.send(cmd_str + self.delim)
-        gen = self.get_socket_response()
-        res = ''.join(list(gen))
-        return loads(res)
+        trace('exec_internal: %s', cmd_str)
+        start = stats.clock()
+        reply = self.channel.request(cmd_str)
+        stats.waited(start)
+        stats.record('euslisp:exec-internal', start)
+        command, value = self._check_reply(reply)
+        if command == Symbol('error'):
+            raise EuslispError(loads(value), self.get_callstack())
+        return loads(value)
+
+    def wait_ready(self):
+        """Blocks until the toplevel is ready to evaluate requests"""
+        with self.lock:
+            if not self.ready:
+                self.get_socket_response()
+                log.info("Successfully started Euslisp process!")
+                self.start_introspection()
+                self.ready = True
+
+    def start_introspection(self):
+        """Starts the introspection thread on the euslisp side.
+
+        Returns False if euslisp is not built with thread support,
+        in which case introspect() falls back to exec_internal()."""
+        cmd = '(slime::slime-connect-introspection {})'.format(
+            self.address_sexp())
+        if not self.exec_internal(cmd):
+            log.info("Introspection thread is not available")
+            return False
+        self.introspection_connected.wait()
+        if self.introspection_channel is None:
+            self.check_poll()
+            return False
+        log.info("...Connected to introspection socket!")
+        return True
+
+    def address_sexp(self):
+        if self.socket_dir:
+            return '"{}"'.format(self.address)
+        return str(self.address)
+
+    def introspect(self, cmd_str):
+        """Evaluates cmd_str without waiting for the toplevel to be idle.
+
+        Only side-effect free queries should be sent this way,
+        as they may run concurrently with the current evaluation."""
+        if self.introspection_channel is None:
+            return self.exec_internal(cmd_str)
+        trace('introspect: %s', cmd_str)
+        start = stats.clock()
+        reply = self.introspection_channel.request(cmd_str)
+        stats.waited(start)
+        stats.record('euslisp:introspect', start)
+        command, value = self._check_reply(reply)
+        if command == Symbol('error'):
+            raise EuslispError(loads(value))
+        return loads(value)
 
     def eval(self, cmd_str):
-        self.output = Queue()
+        self.output.begin()
         self.clear_socket_stack()
-        log.info('eval: %s' % cmd_str)
+        trace('eval: %s', cmd_str)
         self.input(cmd_str)
-        for out in self.get_output():
-            if isinstance(out, str):
-                yield [Symbol(":write-string"), out]
-            else:
-                yield out
+        self.streaming = current_thread()
+        try:
+            for out in self.get_output():
+                if isinstance(out, str):
+                    yield [Symbol(":write-string"), out]
+                else:
+                    yield out
+        finally:
+            with self.stream_end:
+                self.streaming = None
+                self.stream_end.notify_all()
+            self.output.end()
         yield EuslispResult(None)
+
+
+class AttachedEuslispProcess(EuslispProcess):
+    """Euslisp program already running, which called slime-attach-server.
+
+    A connection to the program, the REPL stream, takes the place of
+    the standard input and output of a started process: forms are
+    written to it, and their output and the end-of-eval token are read
+    from it. The program serves it from a thread of its own, which then
+    connects the side channel as a started process does. Stopping only
+    closes the connection, and the program keeps running.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Port on localhost, or pathname of an AF_UNIX socket
+        self.attach = str(kwargs.pop('attach'))
+        kwargs.pop('cpu_limit', None)
+        super(AttachedEuslispProcess, self).__init__(*args, **kwargs)
+        self.repl = None
+        self.repl_closed = False
+
+    def start(self):
+        log.info("Attaching to Euslisp on %s..." % self.attach)
+        try:
+            self.repl = self._connect_repl()
+        except socket.error as e:
+            self._remove_socket()
+            raise EuslispError('Cannot attach to Euslisp on {}: {}'.format(
+                self.attach, e), fatal=True)
+        # The program connects the side channel to this address
+        self.repl.sendall('{}{}'.format(self.address_sexp(), self.delim))
+        self.stdout_fd = self.repl.fileno()
+        self.readers[self.stdout_fd] = self._read_stdout
+        self._start_io_thread()
+        self.channel = self._socket_connect()
+
+    def _connect_repl(self):
+        if self.attach.isdigit():
+            conn = socket.create_connection(('127.0.0.1', int(self.attach)))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(os.path.expanduser(self.attach))
+        return conn
+
+    def stop(self):
+        # Ends the session thread of the program
+        if self.repl is not None and not self.repl_closed:
+            try:
+                self.repl.shutdown(socket.SHUT_RDWR)
+            except socket.error as e:
+                log.warn("failed to detach: %s" % e)
+
+    def running(self):
+        return not self.repl_closed
+
+    def interrupt(self):
+        # Signals would reach the whole program
+        log.warn("Evaluations of an attached Euslisp cannot be interrupted")
+
+    def exited(self):
+        self.repl_closed = True
+        self.repl.close()
+        log.info("Detached from Euslisp on %s" % self.attach)
+
+    def check_poll(self):
+        stats.count('check_poll')
+        if self.repl_closed:
+            raise EuslispError('Attached Euslisp closed the connection',
+                               fatal=True)
+
+    def write(self, data):
+        self.repl.sendall(data)
+
+
+class ProcessPool(object):
+    """Started euslisp processes kept in reserve.
+
+    A process taken with get() has already loaded the init file, so
+    restarting does not wait for it. Replacements are started in the
+    background, as long as the processes in reserve use less than
+    max_memory kB of resident memory.
+    """
+
+    def __init__(self, size=1, max_memory=None, *args, **kwargs):
+        self.size = size
+        self.max_memory = max_memory
+        self.args = args
+        self.kwargs = kwargs
+        self.processes = []
+        self.starting = 0
+        self.closed = False
+        self.lock = Lock()
+
+    def memory(self):
+        return sum(resident_memory(p.process.pid) or 0
+                   for p in self.processes)
+
+    def fill(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.max_memory and self.memory() >= self.max_memory:
+                return
+            num = self.size - len(self.processes) - self.starting
+            self.starting += max(num, 0)
+        for _ in range(num):
+            t = Thread(target=self._spawn)
+            t.daemon = True
+            t.start()
+
+    def _spawn(self):
+        proc = EuslispProcess(*self.args, **self.kwargs)
+        try:
+            proc.start()
+            proc.wait_ready()
+        except Exception:
+            log.error(traceback.format_exc())
+            if proc.process:
+                proc.stop()
+            proc = None
+        with self.lock:
+            self.starting -= 1
+            if proc is None:
+                return
+            if not self.closed:
+                rss = resident_memory(proc.process.pid) or 0
+                if not self.max_memory or \
+                   self.memory() + rss <= self.max_memory:
+                    self.processes.append(proc)
+                    log.info("Standby process %s is ready" % proc.process.pid)
+                    return
+                log.warn("Discard standby process using %s kB" % rss)
+        proc.stop()
+
+    def get(self):
+        """Returns a ready process and starts a replacement,
+        or returns None if no process is available"""
+        proc = None
+        with self.lock:
+            while self.processes and proc is None:
+                proc = self.processes.pop(0)
+                if proc.process.poll() is not None:
+                    proc = None
+        self.fill()
+        return proc
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            processes, self.processes = self.processes, []
+        for proc in processes:
+            proc.stop()
@@ -5,8 +5,9 @@
 import argparse
 
 import euslime
-from euslime.logger import get_logger, set_log_level, LOG_LEVELS
-from euslime.server import serve
+from euslime.logger import configure_trace, get_logger, set_log_level
+from euslime.logger import LOG_LEVELS, TRACE_SIZE
+from euslime.server import serve, MAX_SESSIONS
 
 try:
     _input = raw_input
@@ -45,6 +46,93 @@ def main():
     p.add_argument("--port-filename", type=str,
                    help="Path to file where port number is written",
                    default=str())
+    p.add_argument("--workers", type=int,
+                   help="Number of threads processing swank requests",
+                   default=4)
+    p.add_argument("--no-prestart", action="store_true",
+                   help="Start Euslisp when emacs connects rather than "
+                   "with the server")
+    p.add_argument("--standby", type=int,
+                   help="Number of started Euslisp processes kept "
+                   "in reserve for restarts",
+                   default=0)
+    p.add_argument("--standby-memory", type=int,
+                   help="Maximum resident memory in MB of the processes "
+                   "kept in reserve (0 for no limit)",
+                   default=0)
+    p.add_argument("--output-flush-size", type=int,
+                   help="Bytes of output collected before sending it "
+                   "to emacs",
+                   default=65536)
+    p.add_argument("--output-flush-interval", type=float,
+                   help="Milliseconds to collect continuous output "
+                   "before sending it to emacs",
+                   default=20)
+    p.add_argument("--output-budget", type=int,
+                   help="Megabytes of output per evaluation sent to emacs, "
+                   "the rest is elided (0 for no limit)",
+                   default=8)
+    p.add_argument("--output-spill", action="store_true",
+                   help="Save elided output to a temporary file")
+    p.add_argument("--unix-socket", action="store_true",
+                   help="Connect to Euslisp through a Unix domain socket "
+                   "instead of TCP")
+    p.add_argument("--attach", type=str,
+                   help="Port or socket pathname on which a running "
+                   "Euslisp program called slime-attach-server, "
+                   "instead of starting a new one")
+    p.add_argument("--stats", action="store_true",
+                   help="Collect request latency statistics, "
+                   "returned by swank:euslime-stats")
+    p.add_argument("--stats-file", type=str,
+                   help="Periodically write the statistics to this file "
+                   "as JSON (implies --stats)",
+                   default=str())
+    p.add_argument("--stats-interval", type=float,
+                   help="Seconds between writes of the statistics file",
+                   default=60)
+    p.add_argument("--multi-session", action="store_true",
+                   help="Serve any number of emacs connections, each with "
+                   "its own Euslisp process, until killed")
+    p.add_argument("--max-sessions", type=int,
+                   help="Maximum number of concurrent sessions "
+                   "with --multi-session",
+                   default=MAX_SESSIONS)
+    p.add_argument("--session-memory", type=int,
+                   help="Resident memory in MB beyond which the Euslisp "
+                   "process of a session is killed (0 for no limit)",
+                   default=0)
+    p.add_argument("--session-cpu", type=int,
+                   help="Seconds of CPU time allowed to the Euslisp "
+                   "process of a session (0 for no limit)",
+                   default=0)
+    p.add_argument("--session-timeout", type=float,
+                   help="Minutes after which an idle session is closed "
+                   "with --multi-session (0 for never)",
+                   default=0)
+    p.add_argument("--detach-timeout", type=float,
+                   help="Minutes for which a session is kept while idle "
+                   "after emacs disconnects, for the next connection to "
+                   "reattach (0 to end sessions with their connection), "
+                   "ignored with --multi-session",
+                   default=0)
+    p.add_argument("--detach-buffer", type=int,
+                   help="Kilobytes of output kept for the next connection "
+                   "while a session is detached",
+                   default=1024)
+    p.add_argument("--record", type=str,
+                   help="Record the swank messages of the session to this "
+                   "file, for bench/replay.py (compressed if it ends "
+                   "in .gz)")
+    p.add_argument("--trace-size", type=int,
+                   help="Recent events kept in memory and written to "
+                   "the trace file on errors (0 to disable)",
+                   default=TRACE_SIZE)
+    p.add_argument("--trace-file", type=str,
+                   help="File where traces are written "
+                   "(default: ~/.euslime/trace-PID.log), moved to "
+                   "FILE.1 beyond 16 MB",
+                   default=str())
     p.add_argument("--log-level", "-l", type=str,
                    help="Log Level", default="debug",
                    choices=LOG_LEVELS.keys())
@@ -57,12 +145,34 @@ def main():
         args = p.parse_args(init_string.split())
 
     set_log_level(args.log_level)
+    configure_trace(args.trace_size, args.trace_file)
     serve(host=args.host, port=args.port,
           port_filename=args.port_filename,
           encoding=args.encoding,
           program=args.euslisp_program,
           loader=args.init_file,
-          color=args.color)
+          color=args.color,
+          workers=args.workers,
+          standby=args.standby,
+          standby_memory=args.standby_memory * 1024,
+          flush_size=args.output_flush_size,
+          flush_interval=args.output_flush_interval / 1000.0,
+          output_budget=args.output_budget << 20,
+          output_spill=args.output_spill,
+          unix_socket=args.unix_socket,
+          attach=args.attach,
+          stats=args.stats,
+          stats_file=args.stats_file,
+          stats_interval=args.stats_interval,
+          record=args.record,
+          multi_session=args.multi_session,
+          max_sessions=args.max_sessions,
+          session_memory=args.session_memory * 1024,
+          session_cpu=args.session_cpu,
+          session_timeout=args.session_timeout * 60,
+          detach_timeout=args.detach_timeout * 60,
+          detach_buffer=args.detach_buffer * 1024,
+          prestart=not args.no_prestart)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from sexpdata import Symbol
+
+from euslime.logger import get_logger
+
+log = get_logger(__name__)
+
+# Bumped whenever the layout of an entry changes
+LAYOUT_VERSION = 1
+CACHE_DIR = '~/.euslime/compiled/'
+# Lines of the compiler output reported as notes, first match wins
+NOTE_PATTERNS = [
+    (re.compile(r'\berror\b', re.I), 'error'),
+    (re.compile(r'warning|undefined|assumed|mismatch|unknown|unused',
+                re.I), 'warning'),
+]
+# Forms whose name locates the notes which mention it
+DEFINITION = re.compile(
+    r'^\s*\((?:defun|defmacro|defmethod|defclass|defvar|defparameter|'
+    r'defconstant|defstruct)\s+([^\s()]+)', re.I)
+METHOD = re.compile(r'^\s*\((:[^\s()]+)\s+\(')
+CALL = re.compile(r'\(([^\s()\'"`,;]+)')
+SYMBOL = re.compile(r'[^\s()\'"`,;]+')
+
+
+def content_fingerprint(version, path):
+    """Digest of the euslisp version, and of the name and contents of
+    a source file"""
+    digest = hashlib.sha1()
+    # The name of the object and of its init function come from the
+    # name of the source
+    digest.update('{}\n{}\n{}\n'.format(
+        LAYOUT_VERSION, version, os.path.basename(path)))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def name_lines(path):
+    """Returns the line of the first definition of each name in path,
+    and that of the first call of the names which are not defined"""
+    definitions = {}
+    calls = {}
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            m = DEFINITION.match(line) or METHOD.match(line)
+            if m:
+                definitions.setdefault(m.group(1).lower(), num)
+            for name in CALL.findall(line):
+                calls.setdefault(name.lower(), num)
+    calls.update(definitions)
+    return calls
+
+
+def compiler_notes(output, path):
+    """Extracts the warnings and errors printed by compiler:compile-file.
+
+    Each note is a dict of message, severity and line, the line being
+    that of the first name the message mentions which is defined or
+    called in path."""
+    lines = None
+    notes = []
+    for line in output.splitlines():
+        message = line.strip().strip(';').strip()
+        severity = next((sev for regex, sev in NOTE_PATTERNS
+                         if regex.search(message)), None)
+        if not severity:
+            continue
+        if lines is None:
+            lines = name_lines(path)
+        names = (s.lower() for s in SYMBOL.findall(message))
+        notes.append({'message': message, 'severity': severity,
+                      'line': next((lines[n] for n in names
+                                    if n in lines), None)})
+    return notes
+
+
+def note_sexp(note, filename):
+    """Returns a note of the :compilation-result reply"""
+    if note['line']:
+        location = [Symbol(':location'), [Symbol(':file'), filename],
+                    [Symbol(':line'), note['line'], 0], None]
+    else:
+        location = [Symbol(':error'), 'No source location']
+    return [Symbol(':message'), note['message'],
+            Symbol(':severity'), Symbol(':' + note['severity']),
+            Symbol(':location'), location,
+            Symbol(':references'), None]
+
+
+class CompileCache(object):
+    """Shared objects compiled by euslisp, stored by source contents.
+
+    Each compiled file gets its own directory under CACHE_DIR, named
+    after the fingerprint of its name, its contents and the euslisp
+    version, in which the object keeps the name of the source, as
+    euslisp derives the name of its initialization function from it.
+    Files are compiled once, whatever their directory or modification
+    time.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or CACHE_DIR)
+
+    def entry(self, path, version):
+        fingerprint = content_fingerprint(version, path)
+        return CacheEntry(os.path.join(self.directory, fingerprint[:16]),
+                          path)
+
+
+class CacheEntry(object):
+    def __init__(self, directory, source):
+        self.directory = directory
+        self.name = os.path.splitext(os.path.basename(source))[0]
+        self.shared_object = os.path.join(directory, self.name + '.so')
+        self.notes_file = os.path.join(directory, 'notes.json')
+
+    def exists(self):
+        return os.path.exists(self.notes_file) and \
+            os.path.exists(self.shared_object)
+
+    def notes(self):
+        with open(self.notes_file) as f:
+            return json.load(f)
+
+    def begin(self):
+        """Returns a new directory for the compiler to write to"""
+        parent = os.path.dirname(self.directory)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        # Sessions of a multi-session server share the pid
+        return tempfile.mkdtemp(
+            prefix=os.path.basename(self.directory) + '.', suffix='.tmp',
+            dir=parent) + '/'
+
+    def abort(self, tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def commit(self, tmp, notes):
+        """Stores what was compiled to tmp, returns False if the compiler
+        produced no shared object. Raises OSError if it cannot be stored.
+        """
+        if not os.path.exists(os.path.join(tmp, self.name + '.so')):
+            self.abort(tmp)
+            return False
+        try:
+            with open(os.path.join(tmp, 'notes.json'), 'w') as f:
+                json.dump(notes, f)
+            # The directory appears with its notes, which exists() checks
+            os.rename(tmp, self.directory)
+        except (IOError, OSError):
+            self.abort(tmp)
+            if not self.exists():
+                raise
+            log.debug("%s was stored meanwhile by another session" %
+                      self.directory)
+            return True
+        log.info("Saved %s to %s" % (self.name, self.directory))
+        return True
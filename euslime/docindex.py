@@ -0,0 +1,139 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+from collections import namedtuple
+from threading import Lock
+
+from sexpdata import loads
+
+from euslime.logger import get_logger
+
+log = get_logger(__name__)
+
+# Bumped whenever the schema or the extracted contents change
+FORMAT_VERSION = 1
+INDEX_DIR = '~/.euslime/'
+# help-item types of methods, functions, macros and special forms
+FUNCTION_TYPES = (1, 2, 3, 6)
+
+DocEntry = namedtuple('DocEntry', ['type', 'arglist', 'doc'])
+
+
+def source_fingerprint(version, tex_dir):
+    """Digest of the euslisp version and of the LaTeX sources of the manual"""
+    digest = hashlib.sha1()
+    digest.update('{}\n{}\n{}\n'.format(FORMAT_VERSION, version, tex_dir))
+    if tex_dir and os.path.isdir(tex_dir):
+        for name in sorted(os.listdir(tex_dir)):
+            st = os.stat(os.path.join(tex_dir, name))
+            digest.update('{} {} {}\n'.format(name, st.st_size,
+                                              int(st.st_mtime)))
+    return digest.hexdigest()
+
+
+def to_unicode(s):
+    # sqlite3 does not accept non-ascii byte strings
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def read_arglist(name, arglist):
+    # Same as slime::read-help-item
+    if not isinstance(arglist, (str, unicode)):
+        return None
+    try:
+        return loads(u'({} {})'.format(name, arglist))
+    except Exception:
+        log.debug("Cannot read arglist of %s: %s" % (name, arglist))
+        return None
+
+
+class DocIndex(object):
+    """Documentation of the EusLisp manual, stored in sqlite.
+
+    Each set of doc sources gets its own file under INDEX_DIR, named after
+    its fingerprint, so that an index is built only once per version and
+    different euslisp programs do not overwrite each other's index.
+    """
+
+    def __init__(self, fingerprint, directory=None):
+        self.directory = os.path.expanduser(directory or INDEX_DIR)
+        self.path = os.path.join(
+            self.directory, 'doc-index-{}.sqlite'.format(fingerprint[:16]))
+        self.db = None
+        self.lock = Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def build(self, entries):
+        """Writes the result of slime::help-entries to a new index"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Sessions of a multi-session server share the pid
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+            dir=self.directory)
+        os.close(fd)
+        try:
+            self._write(tmp, entries)
+            # Readers only ever see a complete index
+            os.rename(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        log.info("Saved %d documentation entries to %s" % (
+            len(entries), self.path))
+
+    @staticmethod
+    def _write(path, entries):
+        db = sqlite3.connect(path)
+        try:
+            db.execute('CREATE TABLE docs (class TEXT NOT NULL, '
+                       'name TEXT NOT NULL, type INTEGER, arglist TEXT, '
+                       'doc TEXT, PRIMARY KEY (class, name))')
+            db.executemany(
+                'INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)',
+                ((to_unicode(cls or ''), to_unicode(name), typ,
+                  to_unicode(arglist)
+                  if isinstance(arglist, (str, unicode)) else None,
+                  to_unicode(doc or None))
+                 for cls, name, typ, arglist, doc in entries))
+            db.commit()
+        finally:
+            db.close()
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        # Return utf-8 encoded str, as euslisp results are
+        self.db.text_factory = str
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+    def lookup(self, name, cls=None):
+        with self.lock:
+            if self.db is None:
+                # Replaced by the index of a restarted euslisp
+                return None
+            row = self.db.execute(
+                'SELECT type, arglist, doc FROM docs '
+                'WHERE class = ? AND name = ?',
+                ((cls or '').lower(), name.lower())).fetchone()
+        return DocEntry(*row) if row else None
+
+    def arglist(self, name, cls=None):
+        """Same as slime::get-help"""
+        entry = self.lookup(name, cls)
+        if entry and entry.type in FUNCTION_TYPES:
+            return read_arglist(name.lower(), entry.arglist)
+        return None
+
+    def doc(self, name):
+        entry = self.lookup(name)
+        return entry.doc if entry else None
@@ -0,0 +1,115 @@
+"""Scored fuzzy matching in the style of SLIME's swank-fuzzy contrib"""
+
+import re
+import time
+
+WORD_SEPARATORS = '-*.:/+_'
+# How many candidates to score between checks of the time limit
+CHECK_INTERVAL = 256
+
+
+def char_score(full, pos):
+    if pos == 0:
+        return 10.0
+    if full[pos] in WORD_SEPARATORS:
+        return 1.0
+    if full[pos - 1] in WORD_SEPARATORS:
+        return 8.0
+    if pos == len(full) - 1 or full[pos + 1] in WORD_SEPARATORS:
+        return 6.0
+    return 1.0
+
+
+def score_completion(short, full):
+    """Returns the best (score, chunks) aligning short in full, or None.
+
+    Characters at the beginning of the symbol or of a hyphen-separated
+    word score higher, and consecutive matches reinforce each other,
+    so that "m-v-l" or "mvl" prefer "multiple-value-list".
+    Separators in short only match separators and never get a bonus.
+    chunks is a list of [offset, string] of the matched parts.
+    """
+    m, n = len(short), len(full)
+    if m == 0 or m > n:
+        return None
+    lfull = full.lower()
+    lshort = short.lower()
+    # rows[i][p] = (total, char score, run length, previous position)
+    prev_row = None
+    rows = []
+    for i in range(m):
+        c = lshort[i]
+        row = {}
+        best = None  # best non-contiguous predecessor seen so far
+        for p in range(i, n - m + i + 1):
+            if prev_row is not None and p - 2 in prev_row:
+                cand = prev_row[p - 2]
+                if best is None or cand[0] > best[0][0]:
+                    best = (cand, p - 2)
+            if lfull[p] != c:
+                continue
+            base = char_score(full, p)
+            if prev_row is None:
+                row[p] = (base, base, 1, None)
+                continue
+            entry = None
+            if best is not None:
+                entry = (best[0][0] + base, base, 1, best[1])
+            if p - 1 in prev_row:
+                total, score, run, _ = prev_row[p - 1]
+                if c not in WORD_SEPARATORS:
+                    # separators only keep the run going
+                    score = max(base, score * 0.85 + 1.2 ** run)
+                else:
+                    score = base
+                if entry is None or total + score > entry[0]:
+                    entry = (total + score, score, run + 1, p - 1)
+            if entry is not None:
+                row[p] = entry
+        if not row:
+            return None
+        rows.append(row)
+        prev_row = row
+    last = max(prev_row, key=lambda p: prev_row[p][0])
+    total = prev_row[last][0] + 10.0 / (1 + n - m)
+    # Rebuild matched positions and group them into chunks
+    positions = []
+    pos = last
+    for row in reversed(rows):
+        positions.append(pos)
+        pos = row[pos][3]
+    positions.reverse()
+    chunks = []
+    for p in positions:
+        if chunks and chunks[-1][0] + len(chunks[-1][1]) == p:
+            chunks[-1][1] += full[p]
+        else:
+            chunks.append([p, full[p]])
+    return total, chunks
+
+
+def fuzzy_completions(short, candidates, limit=None, time_limit=None):
+    """Scores candidates against short within the given time limit.
+
+    candidates is an iterable of (name, data) tuples. Returns the
+    `limit' best (score, name, chunks, data) tuples and True when the
+    time limit was exceeded before all candidates were scored.
+    """
+    regex = re.compile('.*?'.join(re.escape(c) for c in short), re.I)
+    deadline = time_limit and time.time() + time_limit
+    results = []
+    interrupted = False
+    for count, (name, data) in enumerate(candidates):
+        if deadline and count % CHECK_INTERVAL == 0 and \
+           time.time() > deadline:
+            interrupted = True
+            break
+        if not regex.search(name):
+            continue
+        res = score_completion(short, name)
+        if res:
+            results.append((res[0], name, res[1], data))
+    results.sort(key=lambda x: (-x[0], x[1]))
+    if limit:
+        results = results[:limit]
+    return results, interrupted
@@ -2,17 +2,36 @@ from __future__ import print_function
 
 import os
 import platform
+import time
 import traceback
 from sexpdata import dumps, loads, Symbol
 from threading import Event
 
+from euslime import stats
+from euslime.bridge import AttachedEuslispProcess
 from euslime.bridge import EuslispError
 from euslime.bridge import EuslispProcess
 from euslime.bridge import EuslispResult
-from euslime.logger import get_logger
+from euslime.bridge import ProcessPool
+from euslime.compilecache import CompileCache
+from euslime.compilecache import compiler_notes
+from euslime.compilecache import note_sexp
+from euslime.docindex import DocIndex
+from euslime.docindex import source_fingerprint
+from euslime.index import append_common
+from euslime.index import LRUCache
+from euslime.index import SymbolIndex
+from euslime.logger import dump_trace, get_logger, trace
 
 log = get_logger(__name__)
 
+# Version and name of the implementation, in a single round trip
+IMPLEMENTATION_QUERY = \
+    '(list (slime::implementation-version) (pathname-name *program-name*))'
+# Fields of the swank:euslime-stats reply, besides :count
+STATS_KEYS = ['mean_ms', 'p50_ms', 'p99_ms', 'max_ms',
+              'euslisp_ms', 'python_ms']
+
 
 def findp(s, l):
     assert isinstance(l, list)
@@ -37,6 +56,71 @@ def current_scope(sexp):
     return scope, cursor
 
 
+def is_symbol(obj, name):
+    return isinstance(obj, Symbol) and obj.value().lower() == name
+
+
+def is_send_form(form):
+    # form: '("send" "obj" ":selector" ...)
+    if not form or len(form) < 3:
+        return False
+    if not all(isinstance(x, (str, unicode)) for x in form[:2]):
+        return False
+    return form[0].lower() == 'send'
+
+
+def keyword_list(arglist, start):
+    # Same as slime::keyword-list
+    keys = []
+    for val in arglist[start:]:
+        key = val[0] if isinstance(val, list) else val
+        if isinstance(key, list):  # &key ((:keyword kwd) 10)
+            keys.append(dumps(key[0]))
+        else:
+            keys.append(':' + dumps(key))
+    return keys
+
+
+def find_prefix(prefix, lst, start=0):
+    # Same as slime::find-prefix
+    length = len(prefix)
+    key = prefix[start:].lower()
+    return append_common(
+        [x for x in lst if x[start:length].lower() == key], length)
+
+
+def set_cursor(arglist, pos):
+    arglist = list(arglist)
+    arglist.insert(pos + 1, Symbol('<==='))
+    arglist.insert(pos, Symbol('===>'))
+    return arglist
+
+
+def set_keyword(arglist, start, item):
+    if isinstance(item, str) or isinstance(item, unicode):
+        keys = [k.lower() for k in keyword_list(arglist, start)]
+        if item.lower() in keys:
+            return set_cursor(arglist, start + keys.index(item.lower()))
+    return arglist
+
+
+def function_autodoc(arglist, cursor=None, form=None):
+    # Same as slime::function-autodoc, given the arglist
+    if not arglist or cursor is None:
+        return arglist
+    length = len(arglist)
+    for i in range(min(length, cursor + 1)):
+        if is_symbol(arglist[i], '&rest'):
+            return set_cursor(arglist, i + 1)
+        elif is_symbol(arglist[i], '&optional'):
+            cursor += 1
+        elif is_symbol(arglist[i], '&key'):
+            return set_keyword(arglist, i, form[-1] if form else None)
+    if cursor <= 0 or cursor >= length:
+        return arglist
+    return set_cursor(arglist, cursor)
+
+
 def qstr(s):
     # double escape characters for string formatting
     return s.encode('utf-8').encode('string_escape').replace('"', '\\"')
@@ -67,40 +151,190 @@ class DebuggerHandler(object):
         else:
             self.message = error
             self.stack = None
+        # Keep what led to the error
+        dump_trace(self.message)
 
 
 class EuslimeHandler(object):
     def __init__(self, *args, **kwargs):
-        self.euslisp = EuslispProcess(*args, **kwargs)
+        standby = kwargs.pop('standby', 0)
+        standby_memory = kwargs.pop('standby_memory', None)
+        self.process_class = EuslispProcess
+        if kwargs.get('attach'):
+            # Restarts reattach to the running program, no standby needed
+            self.process_class = AttachedEuslispProcess
+            standby = 0
+        else:
+            kwargs.pop('attach', None)
+        # Arguments of EuslispProcess, reused on restart
+        self.process_args = (args, kwargs)
+        self.euslisp = self.process_class(*args, **kwargs)
         self.close_request = Event()
         self.euslisp.start()
+        self.standby = None
+        if standby > 0:
+            # Filled once the first process is ready
+            self.standby = ProcessPool(standby, standby_memory,
+                                       *args, **kwargs)
         self.command_id = None
         self.package = None
         self.debugger = []
+        self.index = SymbolIndex()
+        self.index_outdated = True
+        self.arglist_cache = LRUCache()
+        self.docs = None
+        self.implementation = None
+        self.compile_cache = CompileCache()
+
+    def prepare(self):
+        """Waits for euslisp and fetches what connection-info needs.
+
+        Called by the server while emacs is still starting, so that
+        connection-info does not wait for euslisp when it comes."""
+        if self.implementation is not None:
+            return
+        self.euslisp.wait_ready()
+        self.load_doc_index()
+        self.implementation = self.euslisp.exec_internal(IMPLEMENTATION_QUERY)
 
     def restart_euslisp_process(self):
-        program = self.euslisp.program
-        init_file = self.euslisp.init_file
-        color = self.euslisp.color
+        args, kwargs = self.process_args
         self.euslisp.stop()
-        self.euslisp = EuslispProcess(program, init_file, color=color)
-        self.euslisp.start()
+        euslisp = self.standby and self.standby.get()
+        if euslisp is None:
+            euslisp = self.process_class(*args, **kwargs)
+            euslisp.start()
+        else:
+            log.info("Using standby process %s" % euslisp.process.pid)
+        self.euslisp = euslisp
+        self.euslisp.wait_ready()
+        self.load_doc_index()
+        self.index = SymbolIndex()
+        self.invalidate()
+
+    def load_doc_index(self):
+        """Opens the documentation index, building it when the manual
+        changed. Once loaded, euslisp does not generate *help-hash*."""
+        try:
+            version, tex_dir = self.euslisp.exec_internal(
+                '(slime::help-sources)')
+            docs = DocIndex(source_fingerprint(version, tex_dir or None))
+            if not docs.exists():
+                log.info("Building documentation index...")
+                docs.build(self.euslisp.exec_internal(
+                    '(slime::help-entries)'))
+            docs.open()
+            self.euslisp.exec_internal('(slime::use-help-index)')
+        except Exception:
+            log.error(traceback.format_exc())
+            if self.euslisp.running():
+                self.euslisp.reset()
+            return
+        old, self.docs = self.docs, docs
+        if old:
+            old.close()
+
+    def invalidate(self):
+        # Called when an evaluation may have defined or redefined symbols
+        self.index_outdated = True
+        self.arglist_cache.clear()
+
+    def symbol_index(self):
+        # Packages whose symbol counts did not change since the last
+        # update are served from the index without re-reading them
+        with self.index.lock:
+            if self.index_outdated:
+                # Cleared first, so that an evaluation invalidating
+                # the index during the update is not missed
+                self.index_outdated = False
+                try:
+                    state = self.euslisp.introspect(
+                        '(slime::slime-package-state)')
+                    self.index.update(state, lambda name: (
+                        self.euslisp.introspect(
+                            '(slime::slime-package-symbols "{0}")'.format(
+                                qstr(name)))))
+                except Exception:
+                    # Retried on the next request
+                    self.index_outdated = True
+                    raise
+        return self.index
 
     def maybe_new_prompt(self):
         new_prompt = self.euslisp.exec_internal("(slime::slime-prompt)")
         if new_prompt:
             yield [Symbol(":new-package")] + new_prompt
 
+    def cached_arglist(self, func, form=None):
+        """Returns (method-p arglist) of func, memoized until invalidate()
+
+        Method arglists are keyed by the receiver and selector of the
+        (send obj :selector ...) form."""
+        if is_send_form(form):
+            form = form[:3]
+            key = (self.index.current, 'send', dumps(form))
+        else:
+            form = None
+            key = (self.index.current, func.lower())
+        res = self.arglist_cache.get(key)
+        if res is None:
+            generation = self.arglist_cache.generation
+            res = None if form else self.doc_arglist(func)
+            if res is None:
+                cmd = """(slime::autodoc-arglist "{0}" '{1})""".format(
+                    qstr(func), dumps(form))
+                res = self.euslisp.introspect(cmd)
+            if len(res) > 2:
+                # (method-p arglist class), where the manual comes first
+                arglist = self.docs and self.docs.arglist(form[2], res[2])
+                res = [True, arglist or res[1]]
+                if not res[1]:
+                    # As slime::function-autodoc, that of send itself
+                    res = self.cached_arglist(func)
+            self.arglist_cache.put(key, res, generation)
+        return res
+
+    def help_name(self, name):
+        # Same as (string-downcase (format nil "~a" sym))
+        sym = self.symbol_index().find_callable_symbol(name)
+        return self.index.designator(sym).lower() if sym else None
+
+    def doc_arglist(self, func):
+        # The get-help part of slime::lambda-list
+        if self.docs is None:
+            return None
+        arglist = self.docs.arglist(func)
+        if arglist is None:
+            name = self.help_name(func)
+            arglist = name and self.docs.arglist(name)
+        return [False, arglist] if arglist else None
+
     def arglist(self, func, cursor=None, form=None):
         if not isinstance(func, unicode) and not isinstance(func, str):
             log.debug("Expected string at: %s" % func)
             return None
-        cmd = """(slime::autodoc "{0}" {1} '{2})""".format(
-            qstr(func), dumps(cursor), dumps(form))
-        result = self.euslisp.exec_internal(cmd)
-        if isinstance(result, str):
-            return [result, False]
-        elif result:
+        last = form[-1] if form else None
+        if isinstance(last, str) or isinstance(last, unicode):
+            if last == '':
+                cursor -= 1
+                form = form[:-1]
+            elif cursor > 1 and self.symbol_index().boundp(last):
+                # Variable values are not cached
+                cmd = """(slime::autodoc "{0}" {1} '{2})""".format(
+                    qstr(func), dumps(cursor), dumps(form))
+                result = self.euslisp.introspect(cmd)
+                if isinstance(result, str):
+                    return [result, False]
+                elif result:
+                    return [dumps(result), True]
+                return None
+            else:
+                cursor -= 1
+        method_p, arglist = self.cached_arglist(func, form)
+        if method_p and cursor is not None:
+            cursor -= 2
+        result = function_autodoc(arglist, cursor, form)
+        if result:
             return [dumps(result), True]
         return None
 
@@ -113,10 +347,10 @@ class EuslimeHandler(object):
 
     def swank_connection_info(self):
         # Wait for euslisp connection
-        self.euslisp.recv_socket_data()
-        log.info("Successfully started Euslisp process!")
-        version = self.euslisp.exec_internal('(slime::implementation-version)')
-        name = self.euslisp.exec_internal('(pathname-name *program-name*)')
+        self.prepare()
+        if self.standby:
+            self.standby.fill()
+        version, name = self.implementation
         res = {
             'pid': os.getpid(),
             'style': False,
@@ -163,6 +397,8 @@ class EuslimeHandler(object):
         except Exception as e:
             yield [Symbol(":read-aborted"), 0, 1]
             raise e
+        finally:
+            self.invalidate()
 
     def swank_interactive_eval(self, sexp):
         return self.swank_eval(sexp)
@@ -194,7 +430,7 @@ class EuslimeHandler(object):
         try:
             sexp = sexp[1]  # unquote
             scope, cursor = current_scope(sexp)
-            log.debug("scope: %s, cursor: %s" % (scope, cursor))
+            trace("scope: %s, cursor: %s", scope, cursor)
             assert cursor > 0
             func = scope[0]
             scope = scope[:-1]  # remove marker
@@ -219,17 +455,23 @@ class EuslimeHandler(object):
             return self.swank_completions_for_keyword(start, None)
         else:
             return self.swank_simple_completions(start, pkg)
-        # return self.swank_fuzzy_completions(start, pkg, ':limit', 300,
-        #                                     ':time-limit-in-msec', 1500)
 
     def swank_simple_completions(self, start, pkg):
         # (swank:simple-completions "vector-" (quote "USER"))
-        cmd = """(slime::slime-find-symbol "{0}")""".format(qstr(start))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        yield EuslispResult(self.symbol_index().completions(start))
 
     def swank_fuzzy_completions(self, start, pkg, *args):
-        # Unsupported. Use swank_simple_completions instead
-        yield EuslispResult([None, None])
+        # (swank:fuzzy-completions "mvl" "USER"
+        #    :limit 300 :time-limit-in-msec 1500)
+        opts = dict((k.value(), v) for k, v in zip(args[::2], args[1::2]))
+        limit = opts.get(':limit')
+        time_limit = opts.get(':time-limit-in-msec')
+        res, interrupted = self.symbol_index().fuzzy_completions(
+            start, limit=limit, time_limit=time_limit and time_limit / 1000.0)
+        yield EuslispResult([res, interrupted])
+
+    def swank_fuzzy_completion_selected(self, original, completion):
+        return
 
     def swank_completions_for_keyword(self, start, sexp):
         if sexp:
@@ -241,24 +483,46 @@ class EuslimeHandler(object):
                     scope = scope[:-1]
 
         else:
-            scope = None
+            index = self.symbol_index()
+            yield EuslispResult(
+                index.completions(start[1:], prefix=':', package='KEYWORD'))
+            return
+        if self.docs and scope and isinstance(scope[0], (str, unicode)) and \
+           (scope[0].lower() != 'send' or is_send_form(scope)):
+            # Keywords of documented functions are only known here
+            _, arglist = self.cached_arglist(scope[0], scope)
+            keys = []
+            for i, x in enumerate(arglist or []):
+                if is_symbol(x, '&key'):
+                    keys = keyword_list(arglist, i + 1)
+                    break
+            yield EuslispResult(find_prefix(start, keys, 1))
+            return
         cmd = """(slime::slime-find-keyword "{0}" '{1})""".format(
             qstr(start), dumps(scope))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        yield EuslispResult(self.euslisp.introspect(cmd))
 
     def swank_completions_for_character(self, start):
         cmd = """(slime::slime-find-character "{0}")""".format(qstr(start))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        yield EuslispResult(self.euslisp.introspect(cmd))
 
     def swank_complete_form(self, *args):
         # (swank:complete-form
         #    (quote ("float-vector" swank::%cursor-marker%))
         return
 
-    def swank_quit_lisp(self, *args):
+    def close(self):
+        """Stops the euslisp processes of the session"""
+        if self.standby:
+            self.standby.shutdown()
         self.euslisp.stop()
+        if self.docs:
+            self.docs.close()
         self.close_request.set()
 
+    def swank_quit_lisp(self, *args):
+        self.close()
+
     def swank_backtrace(self, start, end):
         res = self.euslisp.get_callstack(end)
         yield EuslispResult(res[start:])
@@ -308,6 +572,7 @@ class EuslimeHandler(object):
         except AssertionError:
             raise Exception('Invalid s-expression in %s' % cmd_str)
         self.euslisp.exec_internal(cmd_str)
+        self.invalidate()
         if len(sexp) > 2:
             msg = dumps(sexp[:2] + [None], none_as='...')
         else:
@@ -321,20 +586,69 @@ class EuslimeHandler(object):
     def swank_compile_notes_for_emacs(self, *args):
         return self.swank_compile_string_for_emacs(*args)
 
-    def swank_compile_file_for_emacs(self, *args):
-        return self.swank_compile_file_if_needed(*args)
+    def compile_file(self, filename):
+        """Compiles filename unless the same contents were compiled before.
+
+        Returns the notes of the compiler, the shared object or None if
+        the compilation failed, and whether it came from the cache."""
+        self.prepare()
+        entry = self.compile_cache.entry(filename, ' '.join(
+            self.implementation))
+        if entry.exists():
+            log.info("Compiled %s found in %s" % (filename, entry.directory))
+            return entry.notes(), entry.shared_object, True
+        tmp = entry.begin()
+        try:
+            output = self.euslisp.exec_internal(
+                '(slime::compile-file-notes "{0}" "{1}")'.format(
+                    qstr(filename), qstr(tmp)))
+        except EuslispError as e:
+            entry.abort(tmp)
+            return [{'message': e.message, 'severity': 'error',
+                     'line': None}], None, False
+        finally:
+            # Macros of the file are defined while compiling
+            self.invalidate()
+        notes = compiler_notes(output or '', filename)
+        try:
+            stored = entry.commit(tmp, notes)
+        except (IOError, OSError) as e:
+            log.error("Failed to save %s: %s" % (entry.directory, e))
+            notes.append({'message': 'Cannot store the compiled file: '
+                          '{}'.format(e), 'severity': 'error', 'line': None})
+            return notes, None, False
+        if not stored:
+            notes.append({'message': 'No shared object was produced',
+                          'severity': 'error', 'line': None})
+            return notes, None, False
+        return notes, entry.shared_object, False
+
+    def compilation_result(self, filename, loadp, if_needed):
+        start = time.time()
+        notes, shared_object, cached = self.compile_file(filename)
+        success = shared_object is not None
+        if cached and if_needed and loadp:
+            # Loaded here, emacs only loads what it asked to compile
+            self.euslisp.exec_internal('(lisp:load "{0}")'.format(
+                qstr(shared_object)))
+            self.invalidate()
+            loadp = shared_object = None
+        return EuslispResult([
+            Symbol(":compilation-result"),
+            [note_sexp(note, filename) for note in notes],
+            success, time.time() - start, loadp, shared_object])
+
+    def swank_compile_file_for_emacs(self, filename, loadp, *args):
+        yield self.compilation_result(filename, loadp, False)
 
     def swank_compile_file_if_needed(self, filename, loadp):
-        # FIXME: This returns without checking/compiling the file
-        errors = []
-        seconds = 0.01
-        yield EuslispResult([Symbol(":compilation-result"), errors, True,
-                             seconds, loadp, filename])
+        yield self.compilation_result(filename, loadp, True)
 
     def swank_load_file(self, filename):
         yield [Symbol(":write-string"), "\nLoading file: %s ..." % filename]
         res = self.euslisp.exec_internal('(lisp:load "{0}")'.format(
             qstr(filename)))
+        self.invalidate()
         yield [Symbol(":write-string"), "\nLoaded."]
         yield EuslispResult(res)
 
@@ -357,7 +671,12 @@ class EuslimeHandler(object):
     def swank_describe_symbol(self, sym):
         cmd = """(slime::slime-describe-symbol "{0}")""".format(
             qstr(sym.strip()))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        res = self.euslisp.introspect(cmd)
+        doc = self.docs and self.docs.doc(
+            self.help_name(sym.strip()) or sym.strip())
+        if doc:
+            res = doc + '\n' + res
+        yield EuslispResult(res)
 
     def swank_describe_function(self, func):
         return self.swank_describe_symbol(func)
@@ -370,21 +689,19 @@ class EuslimeHandler(object):
         yield EuslispResult(self.euslisp.exec_internal(cmd))
 
     def swank_list_all_package_names(self, nicknames=None):
-        cmd = """(slime::slime-all-packages {0})""".format(
-            dumps(nicknames))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        yield EuslispResult(self.symbol_index().package_names(nicknames))
 
     def swank_apropos_list_for_emacs(self, key, external_only=None,
                                      case_sensitive=None, package=None):
         # ignore 'external_only' and 'case_sensitive' arguments
         package = package[-1]  # unquote
-        cmd = """(slime::slime-apropos-list "{0}" {1})""".format(
-            qstr(key), dumps(package))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        yield EuslispResult(self.symbol_index().apropos(key, package))
 
     def swank_set_package(self, name):
         cmd = """(slime::set-package "{0}")""".format(qstr(name))
-        yield EuslispResult(self.euslisp.exec_internal(cmd))
+        res = self.euslisp.exec_internal(cmd)
+        self.invalidate()
+        yield EuslispResult(res)
 
     def swank_default_directory(self):
         res = self.euslisp.exec_internal("(lisp:pwd)")
@@ -394,6 +711,24 @@ class EuslimeHandler(object):
         cmd = """(progn (lisp:cd "{0}") (lisp:pwd))""".format(qstr(dir))
         yield EuslispResult(self.euslisp.exec_internal(cmd))
 
+    def swank_euslime_stats(self):
+        """Returns the latency of each request type in milliseconds,
+        or nil when statistics are not enabled"""
+        if not stats.enabled:
+            yield EuslispResult(None)
+            return
+        snapshot = stats.snapshot()
+        requests = []
+        for name, summary in sorted(snapshot['requests'].items()):
+            entry = [name, Symbol(':count'), summary['count']]
+            for key in STATS_KEYS:
+                entry += [Symbol(':' + key.replace('_', '-')),
+                          round(summary[key], 3)]
+            requests.append(entry)
+        counters = sorted(snapshot['counters'].items())
+        yield EuslispResult([Symbol(':requests'), requests,
+                             Symbol(':counters'), [list(x) for x in counters]])
+
 
 if __name__ == '__main__':
     h = EuslimeHandler()
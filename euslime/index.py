@@ -0,0 +1,328 @@
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from itertools import chain
+from threading import Lock
+
+from sexpdata import Symbol
+
+from euslime.fuzzy import fuzzy_completions
+from euslime.logger import get_logger
+
+log = get_logger(__name__)
+
+# key is the upper-cased pname, used for case-insensitive lookups
+Entry = namedtuple('Entry', ['key', 'name', 'external', 'home', 'kind', 'doc'])
+
+# Flags of swank's symbol-classification-string: "bfgctmsp"
+CLASSIFICATION = {
+    ':variable': 'b-------',
+    ':class': 'b--c----',
+    ':function': '-f------',
+    ':macro': '-f---m--',
+    ':special-operator': '-f----s-',
+    ':package': '-------p',
+}
+
+
+def split_package(name):
+    # Same as slime::split-package
+    pos = name.rfind(':')
+    if pos < 0:
+        return None, name
+    if pos == 0:
+        return 'KEYWORD', name[1:]
+    internal = name[pos - 1] == ':'
+    return name[:pos - 1 if internal else pos].upper(), name[pos + 1:]
+
+
+def get_common(lst, start=0):
+    end = min(len(x) for x in lst)
+    for i in range(start, end):
+        c = lst[0][i]
+        for s in lst:
+            if s[i] != c:
+                return i
+    return max(start, end)
+
+
+def append_common(match_lst, start_len):
+    if len(match_lst) > 1:
+        return [match_lst,
+                match_lst[0][:get_common(match_lst, start_len)]]
+    elif match_lst:
+        return [match_lst, match_lst[0]]
+    return None
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache.
+
+    clear() starts a new generation, so that values computed before it
+    can be discarded by passing the generation they were computed in.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.generation = 0
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.generation += 1
+
+
+class Package(object):
+    def __init__(self, names, use, counts):
+        self.names = names
+        self.name = names[0]
+        self.use = use
+        # symcount, intsymcount and the numbers of fbound and bound
+        # symbols, which tell when the kinds of the symbols changed
+        self.counts = counts
+        self.keys = []
+        self.symbols = []
+        self.external_keys = []
+        self.external_symbols = []
+        self.candidates = {}
+
+    def load(self, entries):
+        """Sets symbols from the result of slime::slime-package-symbols"""
+        symbols = []
+        for e in entries:
+            kind, doc = (e[3:5] + [None, None])[:2]
+            symbols.append(Entry(e[0].upper(), e[0], bool(e[1]),
+                                 e[2] or self.name, kind, doc))
+        symbols.sort(key=lambda x: (x.key, x.name))
+        self.symbols = symbols
+        self.keys = [x.key for x in symbols]
+        self.external_symbols = [x for x in symbols if x.external]
+        self.external_keys = [x.key for x in self.external_symbols]
+
+    def find_prefix(self, prefix, external=False):
+        if external:
+            keys, symbols = self.external_keys, self.external_symbols
+        else:
+            keys, symbols = self.keys, self.symbols
+        prefix = prefix.upper()
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            yield symbols[i]
+            i += 1
+
+    def fuzzy_candidates(self, downcase, external=False):
+        """Cached list of (name, kind) used for fuzzy matching"""
+        key = (downcase, external)
+        if key not in self.candidates:
+            symbols = self.external_symbols if external else self.symbols
+            self.candidates[key] = [
+                (x.name.lower() if downcase else x.name,
+                 x.kind.value() if x.kind else None) for x in symbols]
+        return self.candidates[key]
+
+    def find(self, key, external=False):
+        for sym in self.find_prefix(key, external):
+            if sym.key == key:
+                yield sym
+
+
+class SymbolIndex(object):
+    """Python-side mirror of the euslisp symbol table.
+
+    It is built from per-package symbol dumps and answers completion,
+    apropos and package listing queries without a round-trip to euslisp.
+    """
+
+    def __init__(self):
+        self.packages = []
+        self.package_table = {}
+        self.current = 'USER'
+        self.downcase = False
+        self.lock = Lock()
+
+    def update(self, state, fetch):
+        """Synchronizes the index with the euslisp side.
+
+        state is the result of slime::slime-package-state and fetch is
+        called with a package name to obtain its symbol dump. Only
+        packages whose symbol counts, or counts of bound and fbound
+        symbols, changed are fetched again.
+        """
+        current, downcase, package_lst = state
+        old = dict((p.name, p) for p in self.packages)
+        packages = []
+        for entry in package_lst:
+            names, use, counts = entry[0], entry[1], tuple(entry[2:])
+            pkg = old.get(names[0])
+            if pkg and pkg.counts == counts:
+                pkg.names, pkg.use = names, use
+            else:
+                log.debug("Indexing symbols of package %s" % names[0])
+                pkg = Package(names, use, counts)
+                pkg.load(fetch(pkg.name))
+            packages.append(pkg)
+        table = {}
+        for pkg in packages:
+            for name in pkg.names:
+                table[name.upper()] = pkg
+        self.current = current
+        self.downcase = bool(downcase)
+        self.packages = packages
+        self.package_table = table
+
+    def find_package(self, name):
+        return self.package_table.get(name.upper())
+
+    def find_callable_symbol(self, name):
+        # Same as slime::find-callable-symbol
+        pack, name = split_package(name)
+        key = name.upper()
+        if pack:
+            pkg = self.find_package(pack)
+            return next(pkg.find(key), None) if pkg else None
+        pkg = self.find_package(self.current)
+        if pkg is None:
+            return None
+        for sym in pkg.find(key):
+            return sym
+        for used in filter(None, map(self.find_package, pkg.use)):
+            for sym in used.find(key, external=True):
+                return sym
+        return None
+
+    def boundp(self, name):
+        """True if name refers to a bound, non-keyword symbol"""
+        sym = self.find_callable_symbol(name)
+        if sym is None or sym.kind is None or sym.home == 'KEYWORD':
+            return False
+        return sym.kind.value() in (':variable', ':class')
+
+    def maybe_downcase(self, name):
+        return name.lower() if self.downcase else name
+
+    def callable_symbols(self, prefix, package=None):
+        pkg = self.find_package(package or self.current)
+        if pkg is None:
+            return
+        for sym in pkg.find_prefix(prefix):
+            yield sym
+        for name in pkg.use:
+            used = self.find_package(name)
+            if used:
+                for sym in used.find_prefix(prefix, external=True):
+                    yield sym
+
+    def completions(self, start, prefix=None, package=None):
+        # Same as slime::slime-find-symbol
+        pack, name = split_package(start)
+        length = len(name)
+        prefix = prefix or str()
+        str_lst = []
+        if not (pack or prefix):
+            upper = name.upper()
+            for pkg in self.packages:
+                if pkg.counts[1] > 0 and pkg.name.upper().startswith(upper):
+                    str_lst.append(
+                        "{}:".format(self.maybe_downcase(pkg.name)))
+        if pack:
+            pkg = self.find_package(pack)
+            symbols = pkg.find_prefix(name) if pkg else []
+        else:
+            symbols = self.callable_symbols(name, package)
+        for sym in symbols:
+            sym_str = self.maybe_downcase(sym.name)
+            str_lst.append(prefix + start + sym_str[length:])
+        return append_common(sorted(str_lst), length)
+
+    def package_names(self, nicknames=None):
+        # Same as slime::slime-all-packages
+        if nicknames:
+            return [n for p in self.packages for n in p.names]
+        return [p.name for p in self.packages]
+
+    def accessible(self, sym):
+        pkg = self.find_package(self.current)
+        if pkg is None:
+            return False
+        if any(s.home == sym.home for s in pkg.find(sym.key)):
+            return True
+        for name in pkg.use:
+            used = self.find_package(name)
+            if used and any(s.home == sym.home
+                            for s in used.find(sym.key, external=True)):
+                return True
+        return False
+
+    def designator(self, sym):
+        # Same as (string-upcase (format nil "~a" sym))
+        if sym.home == 'KEYWORD':
+            return ':' + sym.key
+        if self.accessible(sym):
+            return sym.key
+        home = self.find_package(sym.home)
+        external = home and any(home.find(sym.key, external=True))
+        return '{}{}{}'.format(sym.home.upper(), ':' if external else '::',
+                               sym.key)
+
+    def apropos(self, key, package=None):
+        # Same as slime::slime-apropos-list
+        key = key.upper()
+        if package:
+            packages = filter(None, [self.find_package(package)])
+        else:
+            packages = self.packages
+        res = {}
+        for pkg in packages:
+            for sym in pkg.symbols:
+                if sym.kind and key in sym.key:
+                    name = self.designator(sym)
+                    res[name] = [Symbol(':designator'), name,
+                                 sym.kind, sym.doc]
+        return [res[k] for k in sorted(res)]
+
+    def fuzzy_completions(self, start, limit=None, time_limit=None):
+        """Returns ((completion score chunks classification) ...)
+        and whether the time limit was exceeded"""
+        pack, name = split_package(start)
+        prefix = start[:len(start) - len(name)]
+        sources = []
+        if pack:
+            sources.append((self.find_package(pack), False))
+        else:
+            pkg = self.find_package(self.current)
+            sources.append((pkg, False))
+            if pkg:
+                sources.extend((self.find_package(x), True) for x in pkg.use)
+        candidates = [(self.maybe_downcase(p.name) + ':', ':package')
+                      for p in self.packages if not pack and p.counts[1] > 0]
+        candidates = chain(candidates, *[
+            p.fuzzy_candidates(self.downcase, external)
+            for p, external in sources if p])
+        results, interrupted = fuzzy_completions(
+            name, candidates, limit=limit, time_limit=time_limit)
+        completions = []
+        for score, sym_str, chunks, kind in results:
+            for chunk in chunks:
+                chunk[0] += len(prefix)
+            completions.append([prefix + sym_str, score, chunks,
+                                CLASSIFICATION.get(kind, '--------')])
+        return completions, interrupted
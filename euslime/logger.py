@@ -1,7 +1,13 @@
 import json
 import logging
 import logging.config
+import os
+import time
+from collections import deque
 from logging import DEBUG, INFO, WARN, ERROR, FATAL  # NOQA
+from Queue import Queue
+from thread import get_ident
+from threading import Lock, Thread
 
 
 LOG_LEVELS = {
@@ -36,6 +42,15 @@ _DEFAULT_CONFIG = {
 _LOG_CONFIGURED = False
 _LOGGERS = {}
 
+# Number of recent events kept for dump_trace()
+TRACE_SIZE = 4096
+# Characters kept of each string argument of an event
+TRACE_DATA = 512
+# Contains the evaluated code, so only readable by the user
+TRACE_FILE = '~/.euslime/trace-{pid}.log'
+# Bytes beyond which the trace file is moved to FILE.1 and started anew
+TRACE_FILE_SIZE = 16 << 20
+
 
 def get_logger(ns=__name__, cfg_path=None):
     global _LOG_CONFIGURED
@@ -58,3 +73,111 @@ def set_log_level(level):
         level = LOG_LEVELS[level]
     for l in _LOGGERS.values():
         l.setLevel(level)
+
+
+class Tracer(object):
+    """Ring buffer of recent events, formatted only when dumped.
+
+    Recording an event stores its format string and arguments, long
+    strings being clipped, so that tracing the hot paths costs little
+    more than a deque append. Dumps are formatted and written to the
+    trace file by a background thread, the previous file being kept
+    as FILE.1 once it grows beyond max_bytes.
+    """
+
+    def __init__(self, size=TRACE_SIZE, path=None, max_bytes=TRACE_FILE_SIZE):
+        self.events = deque(maxlen=size)
+        self.path = os.path.expanduser(
+            path or TRACE_FILE.format(pid=os.getpid()))
+        self.max_bytes = max_bytes
+        self.queue = None
+        self.lock = Lock()
+
+    def record(self, msg, args):
+        self.events.append((time.time(), get_ident(), msg, [
+            a[:TRACE_DATA] if isinstance(a, basestring) else a
+            for a in args]))
+
+    def dump(self, error):
+        """Writes the events recorded since the last dump"""
+        events = []
+        try:
+            while True:
+                events.append(self.events.popleft())
+        except IndexError:
+            pass
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue()
+                t = Thread(target=self._writer)
+                t.daemon = True
+                t.start()
+        self.queue.put((time.time(), error, events))
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # Neither follows a link put in place of the file,
+        # nor lets other users read it
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_NOFOLLOW
+        fd = os.open(self.path, flags, 0o600)
+        if os.fstat(fd).st_size > self.max_bytes:
+            os.close(fd)
+            os.rename(self.path, self.path + '.1')
+            fd = os.open(self.path, flags | os.O_EXCL, 0o600)
+        return os.fdopen(fd, 'a')
+
+    def _writer(self):
+        while True:
+            stamp, error, events = self.queue.get()
+            try:
+                with self._open() as f:
+                    f.write('=== {} Error: {}\n'.format(
+                        _format_time(stamp), _to_str(error)))
+                    for event in events:
+                        f.write(_format_event(*event))
+            except (IOError, OSError) as e:
+                get_logger(__name__).warn("Failed to write trace: %s" % e)
+            else:
+                get_logger(__name__).info("Trace written to %s" % self.path)
+
+
+def _format_time(stamp):
+    return '{}.{:06d}'.format(time.strftime('%H:%M:%S', time.localtime(stamp)),
+                              int(stamp % 1 * 1e6))
+
+
+def _to_str(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return str(obj)
+
+
+def _format_event(stamp, ident, msg, args):
+    try:
+        text = _to_str(msg % tuple(args) if args else msg)
+    except Exception as e:
+        text = '{} {!r} ({})'.format(msg, args, e)
+    return '{} [{:x}] {}\n'.format(_format_time(stamp), ident, text)
+
+
+_TRACER = Tracer()
+
+
+def configure_trace(size=TRACE_SIZE, path=None):
+    """Sets the number of events kept, 0 disabling tracing"""
+    global _TRACER
+    _TRACER = Tracer(size, path) if size > 0 else None
+
+
+def trace(msg, *args):
+    """Records an event, formatted as msg % args when dumped"""
+    if _TRACER is not None:
+        _TRACER.record(msg, args)
+
+
+def dump_trace(error):
+    """Writes the recent events, which led to error"""
+    if _TRACER is not None:
+        _TRACER.dump(error)
@@ -1,33 +1,52 @@
-from sexpdata import dumps, loads, Symbol
-import signal
+from sexpdata import Symbol
 import traceback
 
+from euslime import stats
 from euslime.bridge import EuslispResult
 from euslime.handler import DebuggerHandler
-from euslime.logger import get_logger
+from euslime.logger import get_logger, trace
+from euslime.sexp import encode_message, loads
 
 log = get_logger(__name__)
 
+# Idempotent introspection requests, of which only the latest one matters,
+# and the cheap value returned in place of the superseded ones
+COALESCED_REQUESTS = {
+    'swank:autodoc': [Symbol(':not-available'), True],
+    'swank:operator-arglist': None,
+    'swank:completions': None,
+    'swank:simple-completions': None,
+    'swank:fuzzy-completions': [None, None],
+    'swank:completions-for-keyword': None,
+    'swank:completions-for-character': None,
+}
+
 
 class Protocol(object):
     def __init__(self, handler, *args, **kwargs):
+        # Encoding of the messages returned by dumps
+        self.encoding = kwargs.pop('encoding', 'utf-8')
         self.handler = handler(*args, **kwargs)
+        self.latest_request = {}
+
+    def parse(self, data):
+        """Reads a swank message and records the id of the latest
+        coalesced request. Must be called in order of arrival."""
+        data = loads(data)
+        if data[0] == Symbol(":emacs-rex"):
+            name = data[1][0].value().lower()
+            if name in COALESCED_REQUESTS:
+                self.latest_request[name] = data[-1]
+        return data
+
+    def superseded(self, name, comm_id):
+        if name not in COALESCED_REQUESTS:
+            return False
+        return self.latest_request.get(name) != comm_id
 
     def dumps(self, sexp):
-        def with_header(sexp):
-            res = dumps(sexp, false_as='nil', none_as='nil')
-            # encode to adapt to japanese characters
-            header = '{0:06x}'.format(len(res.encode('utf-8')))
-            return header + res
-        try:
-            return with_header(sexp)
-        except UnicodeDecodeError:
-            # For example in (apropos "default")
-            log.warn('UnicodeDecodeError at %s' % sexp)
-            assert isinstance(sexp, list)
-            sexp = [unicode(x, 'utf-8', 'ignore') if isinstance(x, str)
-                    else x for x in sexp]
-            return with_header(sexp)
+        """Returns the encoded message, ready to be sent"""
+        return encode_message(sexp, self.encoding)
 
     def make_error(self, id, err):
         debug = DebuggerHandler(id, err)
@@ -52,28 +71,42 @@ class Protocol(object):
             for r in self.make_error(id, e):
                 yield r
 
-    def interrupt(self):
+    def interrupt(self, comm_id=None):
+        """Aborts the evaluation of request comm_id, by default the
+        latest request"""
         yield self.dumps([Symbol(":read-aborted"), 0, 1])
-        self.handler.euslisp.process.send_signal(signal.SIGINT)
+        self.handler.euslisp.interrupt()
         self.handler.euslisp.reset()
         yield self.dumps([Symbol(':return'),
                           {'abort': "'Keyboard Interrupt'"},
-                          self.handler.command_id])
+                          comm_id or self.handler.command_id])
 
     def process(self, data):
-        data = loads(data)
         if data[0] == Symbol(":emacs-rex"):
             cmd, form, pkg, thread, comm_id = data
+            name = form[0].value().lower()
+            if self.superseded(name, comm_id):
+                # Do not bother euslisp with requests nobody waits for
+                trace("Skipping superseded request %s", comm_id)
+                for r in self.make_response(comm_id,
+                                            COALESCED_REQUESTS[name]):
+                    yield r
+                return
+            start = stats.begin_request()
             self.handler.command_id = comm_id
             self.handler.package = pkg
+            # Requests may run concurrently, so do not rely on
+            # handler.command_id which is set by the latest one
+            ret_id = comm_id
         else:
             form = data
             comm_id = None
+            ret_id = self.handler.command_id
+            name = start = None
         func = form[0].value().replace(':', '_').replace('-', '_')
         args = form[1:]
 
-        log.info("func: %s" % func)
-        log.info("args: %s" % args)
+        trace("func: %s, args: %s", func, args)
 
         try:
             gen = getattr(self.handler, func)(*args)
@@ -84,12 +117,17 @@ class Protocol(object):
                 return
             for resp in gen:
                 if isinstance(resp, EuslispResult):
-                    for r in self.make_response(self.handler.command_id,
-                                                resp.value):
+                    for r in self.make_response(ret_id, resp.value):
+                        # Stop the clock once the reply is ready, as the
+                        # next request may be read before we resume
+                        stats.end_request(name, start)
+                        start = None
                         yield r
                 else:
                     yield self.dumps(resp)
         except Exception as e:
             log.error(traceback.format_exc())
-            for r in self.make_error(self.handler.command_id, e):
+            for r in self.make_error(ret_id, e):
                 yield r
+        finally:
+            stats.end_request(name, start)
@@ -0,0 +1,63 @@
+import gzip
+import time
+from threading import Lock
+
+# Directions of the recorded messages
+FROM_EMACS = '>'
+TO_EMACS = '<'
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class Recorder(object):
+    """Writes the swank messages of a session to a file.
+
+    Each message is written as its direction, the seconds elapsed since
+    the start of the session and the message with its length header:
+
+      > 0.001234 00001d(:emacs-rex (swank:foo) ...)
+
+    followed by a newline. Files ending in .gz are compressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = _open(path, 'wb')
+        self.lock = Lock()
+        self.start = time.time()
+
+    def record(self, direction, payload):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write('{} {:.6f} {:06x}'.format(
+                direction, time.time() - self.start, len(payload)))
+            self.file.write(payload)
+            self.file.write('\n')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_recording(path):
+    """Returns the (direction, seconds, payload) of each recorded message"""
+    with _open(path, 'rb') as f:
+        data = f.read()
+    messages = []
+    pos = 0
+    while pos < len(data):
+        direction = data[pos]
+        end = data.index(' ', pos + 2)
+        seconds = float(data[pos + 2:end])
+        length = int(data[end + 1:end + 7], 16)
+        start = end + 7
+        messages.append((direction, seconds, data[start:start + length]))
+        pos = start + length + 1
+    return messages
@@ -3,48 +3,329 @@ try:
 except ImportError:
     import socketserver as S
 
+import errno
+import os
+import select
 import socket
 import time
 import traceback
+from collections import deque
+from itertools import count
+from Queue import Full, Queue
+from sexpdata import Symbol
 from thread import start_new_thread
-from threading import Event
+from threading import Event, Lock, Thread
 
+from euslime import stats as euslime_stats
+from euslime.bridge import resident_memory, split_frames
 from euslime.handler import EuslimeHandler
 from euslime.protocol import Protocol
-from euslime.logger import get_logger
+from euslime.record import FROM_EMACS, TO_EMACS, Recorder
+from euslime.logger import get_logger, trace
 
 ENCODINGS = {
     'iso-latin-1-unix': 'latin-1',
     'iso-utf-8-unix': 'utf-8'
 }
-HEADER_LENGTH = 6
+BUFSIZE = 65536
+WORKERS = 4
+# Messages which must not wait behind a running evaluation
+INLINE_MESSAGES = ('(:emacs-interrupt', '(:emacs-return-string')
+# Requests held while the workers are busy, beyond which emacs is no
+# longer read, interrupts included
+BACKLOG_SIZE = 256
+# Seconds between attempts to hand the held requests to the workers
+BACKLOG_POLL = 0.02
+MAX_SESSIONS = 16
+# Seconds between checks of the session limits
+REAP_INTERVAL = 5
+# Seconds given to the workers to send their last replies on close
+DRAIN_TIMEOUT = 5
+# Bytes of output kept for emacs while a session is detached
+DETACH_BUFFER = 1 << 20
+# Replies to previous connections which are still delivered
+OUTPUT_MESSAGE = '(:write-string '
+REPL_REQUESTS = frozenset(['swank-repl:create-repl', 'swank:create-repl'])
+# Requests evaluated by the toplevel, which :emacs-interrupt stops
+EVAL_REQUESTS = frozenset([
+    'swank-repl:listener-eval', 'swank:interactive-eval',
+    'swank:interactive-eval-region', 'swank:pprint-eval'])
 
 log = get_logger(__name__)
 
 
+class WorkerPool(object):
+    """Fixed number of threads consuming a bounded task queue"""
+
+    def __init__(self, size=WORKERS, maxsize=None):
+        self.tasks = Queue(maxsize or size * 8)
+        self.threads = [Thread(target=self._worker) for _ in range(size)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                log.error(traceback.format_exc())
+
+    def submit(self, func, *args):
+        # Blocks when the queue is full
+        self.tasks.put((func, args))
+
+    def try_submit(self, func, *args):
+        """Returns False instead of blocking when the queue is full"""
+        try:
+            self.tasks.put_nowait((func, args))
+        except Full:
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        """Stops the threads once the queued tasks are done,
+        waiting at most timeout seconds for them if given"""
+        for _ in self.threads:
+            self.tasks.put(None)
+        if timeout:
+            deadline = time.time() + timeout
+            for t in self.threads:
+                t.join(max(deadline - time.time(), 0))
+
+
+class MissedOutput(object):
+    """Output messages emacs missed while detached, at most size bytes.
+
+    The oldest messages are dropped first and counted.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or DETACH_BUFFER
+        self.messages = deque()
+        self.length = 0
+        self.dropped = 0
+
+    def add(self, send_data):
+        self.messages.append(send_data)
+        self.length += len(send_data)
+        while self.length > self.size:
+            msg = self.messages.popleft()
+            self.length -= len(msg)
+            self.dropped += len(msg)
+
+    def take(self):
+        """Returns the messages and the bytes dropped, emptying self"""
+        messages, dropped = list(self.messages), self.dropped
+        self.messages.clear()
+        self.length = self.dropped = 0
+        return messages, dropped
+
+
+def is_repl_request(data):
+    return data[0] == Symbol(':emacs-rex') and \
+        data[1][0].value().lower() in REPL_REQUESTS
+
+
+def is_eval_request(data):
+    return data[0] == Symbol(':emacs-rex') and \
+        data[1][0].value().lower() in EVAL_REQUESTS
+
+
 class EuslimeRequestHandler(S.BaseRequestHandler, object):
+    """One emacs connection, with its own euslisp process.
+
+    If detach_timeout is set on the server, the session outlives the
+    connection: when emacs disconnects without quitting, euslisp and
+    the requests in progress keep running, and the output they send
+    is kept in a bounded buffer. The next connection takes over the
+    session, and gets the missed output once it
+    creates its REPL. Replies to the requests of the previous
+    connection other than output are dropped, as their ids mean
+    nothing to the new one.
+    """
+
     def __init__(self, request, client_address, server):
-        self.swank = Protocol(EuslimeHandler, server.program, server.loader)
-        self.swank.handler.euslisp.color = server.color
+        session = server.reattach_session(client_address)
+        if session is not None:
+            session.reattach(request, client_address)
+            return
+        self.session_id = next(server.session_counter)
         self.encoding = ENCODINGS.get(server.encoding, 'utf-8')
-        self.interrupt_request = Event()
+        self.swank = server.take_prestarted() or server.new_protocol()
+        # (request id, Event) of the running evaluation, the event
+        # being set to stop the worker processing it
+        self.interrupt_request = None
+        self.send_lock = Lock()
+        self.workers = WorkerPool(server.workers)
+        # (request, generation) waiting for room in the worker queue
+        self.backlog = deque()
+        # Incremented on each reattach, to tell replies to
+        # previous connections apart
+        self.generation = 0
+        self.connected = True
+        self.detached_since = None
+        self.replaying = False
+        self.missed = MissedOutput(server.detach_buffer)
+        # Requests in progress, and time of the latest message
+        self.activity_lock = Lock()
+        self.pending = 0
+        self.last_activity = time.time()
+        self.recorder = None
+        if server.record:
+            path = server.record_path(self.session_id)
+            self.recorder = Recorder(path)
+            log.info("Recording session to %s" % path)
         super(EuslimeRequestHandler, self).__init__(
             request, client_address, server)
 
-    def _process_data(self, recv_data):
+    def setup(self):
+        self.server.add_session(self)
+
+    def _send(self, send_data, generation=None):
+        trace('response: %s', send_data)
+        current = generation in (None, self.generation)
+        output = send_data.startswith(OUTPUT_MESSAGE, 6)
+        with self.send_lock:
+            if self.connected and (current or output and not self.replaying):
+                try:
+                    self._write(send_data)
+                    return
+                except socket.error:
+                    if not self.server.detach_timeout:
+                        raise
+                    # The handle loop detaches on EOF
+                    self.connected = False
+            if output:
+                self.missed.add(send_data)
+
+    def _write(self, send_data):
+        if self.recorder:
+            self.recorder.record(TO_EMACS, send_data[6:])
+        self.request.sendall(send_data)
+
+    def _process_data(self, recv_data, generation=None):
+        evaluation = None
+        if is_eval_request(recv_data):
+            evaluation = self.interrupt_request = (recv_data[-1], Event())
         try:
             for send_data in self.swank.process(recv_data):
-                if self.interrupt_request.is_set():
-                    self.interrupt_request.clear()
+                if evaluation and evaluation[1].is_set():
                     return
-                log.debug('response: %s', send_data)
-                send_data = send_data.encode(self.encoding)
-                self.request.send(send_data)
+                self._send(send_data, generation)
+            if is_repl_request(recv_data):
+                self.server.repl_created()
+                if self.replaying and generation == self.generation:
+                    self._replay()
         except KeyboardInterrupt:
             log.warn("Keyboard Interrupt!")
-            self.interrupt_request.set()
-            for msg in self.swank.interrupt():
-                self.request.send(msg)
+            running = self.interrupt_request
+            if running:
+                running[1].set()
+            for msg in self.swank.interrupt(running and running[0]):
+                self._send(msg, generation)
+        finally:
+            if evaluation and self.interrupt_request is evaluation:
+                self.interrupt_request = None
+            with self.activity_lock:
+                self.pending -= 1
+                self.last_activity = time.time()
+            if self.swank.handler.close_request.is_set():
+                # wake up the handle loop
+                try:
+                    self.request.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass  # already closed by the client
+
+    def idle_time(self):
+        """Seconds since the session last did anything"""
+        with self.activity_lock:
+            if self.pending:
+                return 0
+            return time.time() - self.last_activity
+
+    def close_session(self, reason):
+        log.warn("Closing session %d: %s" % (self.session_id, reason))
+        self.swank.handler.close_request.set()
+        if self.server.claim_detached(self):
+            # No handle loop is left to end it
+            self.end_session()
+            return
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # already closed by the client
+
+    def check_limits(self, timeout=None, memory=None, detach_timeout=None):
+        """Closes the idle session and kills euslisp using too much memory"""
+        if self.detached_since is not None:
+            timeout = detach_timeout
+        if timeout and self.idle_time() > timeout:
+            self.close_session('idle for more than {} s'.format(timeout))
+            return
+        euslisp = self.swank.handler.euslisp
+        # Attached programs are not ours to kill
+        if not memory or euslisp.process is None or not euslisp.running():
+            return
+        rss = resident_memory(euslisp.process.pid)
+        if rss is not None and rss > memory:
+            msg = '; euslime: Euslisp was using {} MB, more than the ' \
+                'limit of {} MB, and has been killed\n'.format(
+                    rss >> 10, memory >> 10)
+            log.warn("Session %d: %s" % (self.session_id, msg.strip()))
+            euslisp.process.kill()
+            try:
+                self._send(self.swank.dumps([Symbol(':write-string'), msg]))
+            except socket.error:
+                pass
+
+    def dispatch(self, recv_data):
+        trace('raw data: %s', recv_data)
+        if self.recorder:
+            self.recorder.record(FROM_EMACS, recv_data)
+        recv_data = recv_data.decode(self.encoding)
+        inline = recv_data.startswith(INLINE_MESSAGES)
+        try:
+            recv_data = self.swank.parse(recv_data)
+        except Exception:
+            log.error(traceback.format_exc())
+            return
+        # Decremented once processed
+        with self.activity_lock:
+            self.pending += 1
+            self.last_activity = time.time()
+        if inline:
+            self._process_data(recv_data, self.generation)
+        elif self.backlog or not self.workers.try_submit(
+                self._process_data, recv_data, self.generation):
+            # Held rather than blocking the reader, which has to go on
+            # reading interrupts of the running evaluations
+            self.backlog.append((recv_data, self.generation))
+
+    def submit_backlog(self):
+        """Hands the held requests to the workers while there is room"""
+        while self.backlog:
+            if not self.workers.try_submit(self._process_data,
+                                           *self.backlog[0]):
+                return
+            self.backlog.popleft()
+
+    def readable(self):
+        """Waits a moment for emacs while requests are held, returns
+        True if the socket is to be read"""
+        if len(self.backlog) >= BACKLOG_SIZE:
+            # Far enough behind to apply back-pressure
+            time.sleep(BACKLOG_POLL)
+            return False
+        try:
+            return bool(select.select([self.request], [], [],
+                                      BACKLOG_POLL)[0])
+        except select.error:
+            return False
 
     def handle(self):
         """This method handles packets from swank client.
@@ -52,35 +333,109 @@ class EuslimeRequestHandler(S.BaseRequestHandler, object):
         followed by a S-exp with newline on the end.
 
         e.g.) 000016(:return (:ok nil) 1)\n
+
+        The loop blocks on the socket until data arrives,
+        splits the stream into packets and hands them to the worker pool.
         """
         log.debug("Entering handle loop...")
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = str()
         while not self.swank.handler.close_request.is_set():
+            if self.backlog:
+                self.submit_backlog()
+                if self.backlog and not self.readable():
+                    continue
             try:
-                head_data = self.request.recv(HEADER_LENGTH,
-                                              socket.MSG_DONTWAIT)
-                log.debug('raw header: %s', head_data)
-                if not head_data:
+                data = self.request.recv(BUFSIZE)
+            except KeyboardInterrupt:
+                log.warn("Nothing to interrupt!")
+                continue
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                log.error(traceback.format_exc())
+                break
+            if not data:
+                if self.server.detach_timeout:
+                    log.info('Emacs disconnected')
+                elif not self.swank.handler.close_request.is_set():
                     log.error('Empty header received. Closing socket.')
-                    self.request.close()
-                    break
-                length = int(head_data, 16)
-                recv_data = self.request.recv(length)
-                log.debug('raw data: %s', recv_data)
-                recv_data = recv_data.decode(self.encoding)
-                start_new_thread(self._process_data, (recv_data,))
-            except socket.timeout:
-                log.error('Socket Timeout')
                 break
-            except socket.error:
-                try:
-                    time.sleep(0.01)
-                except KeyboardInterrupt:
-                    log.warn("Nothing to interrupt!")
-                continue
+            try:
+                frames, buf = split_frames(buf + data)
+                for recv_data in frames:
+                    self.dispatch(recv_data)
             except Exception:
                 log.error(traceback.format_exc())
                 break
 
+        if self.server.detach_timeout and \
+           not self.swank.handler.close_request.is_set():
+            # Euslisp keeps running, the held requests as well
+            while self.backlog:
+                self.workers.submit(self._process_data,
+                                    *self.backlog.popleft())
+            self.detach()
+        else:
+            if self.backlog:
+                log.warn("Dropping %d requests of the closed session" %
+                         len(self.backlog))
+                self.backlog.clear()
+            self.end_session()
+
+    def detach(self):
+        with self.send_lock:
+            self.connected = False
+            self.request.close()
+        with self.activity_lock:
+            self.last_activity = time.time()
+        self.server.detach_session(self)
+        log.info("Session %d detached, kept for %d s while idle" % (
+            self.session_id, self.server.detach_timeout))
+
+    def reattach(self, request, client_address):
+        """Serves the new connection in place of the previous one"""
+        log.info("Session %d reattached by %s" % (
+            self.session_id, client_address[0]))
+        handler = self.swank.handler
+        if handler.debugger:
+            # The new emacs knows nothing of the debugger levels
+            handler.debugger = []
+            handler.euslisp.reset()
+            self.missed.add(self.swank.dumps([
+                Symbol(':write-string'),
+                '; euslime: returned to the toplevel from the debugger\n']))
+        with self.send_lock:
+            self.request = request
+            self.client_address = client_address
+            self.generation += 1
+            self.connected = True
+            self.replaying = True
+        self.handle()
+
+    def _replay(self):
+        with self.send_lock:
+            messages, dropped = self.missed.take()
+            self.replaying = False
+            if dropped:
+                messages.insert(0, self.swank.dumps([
+                    Symbol(':write-string'),
+                    '; euslime: {} kB of output missed while detached '
+                    'were dropped\n'.format(dropped >> 10)]))
+            for send_data in messages:
+                self._write(send_data)
+
+    def end_session(self):
+        # Requests waiting for euslisp return once it is stopped
+        self.swank.handler.close()
+        self.workers.shutdown(DRAIN_TIMEOUT)
+        self.request.close()
+        if self.recorder:
+            self.recorder.close()
+        self.server.remove_session(self)
+        if self.server.multi_session:
+            log.info("Session %d closed" % self.session_id)
+            return
         log.warn("Server is shutting down")
 
         # to kill daemon
@@ -89,23 +444,240 @@ class EuslimeRequestHandler(S.BaseRequestHandler, object):
         start_new_thread(kill_server, (self.server,))
 
 
-class EuslimeServer(S.TCPServer, object):
+class EuslimeServer(S.ThreadingMixIn, S.TCPServer, object):
+    """Swank server, each connection having its own euslisp process.
+
+    Serves a single session unless multi_session is set, in which case
+    up to max_sessions connections are served at once until the server
+    is killed. Sessions idle for session_timeout seconds are closed,
+    and euslisp processes are killed beyond session_memory kB of
+    resident memory or session_cpu seconds of CPU time. With attach,
+    the port or socket pathname given to slime-attach-server by a
+    running euslisp program, sessions are served by that program
+    instead of a started process. With detach_timeout, sessions whose
+    emacs disconnects are kept until idle for that many seconds, and
+    keep up to detach_buffer bytes of output for the next connection.
+    Sessions are not detachable with multi_session.
+    Unless prestart is False, the euslisp process of the first session
+    is started as soon as the port is bound, while emacs connects.
+    """
+    daemon_threads = True
+
     def __init__(self, server_address,
                  handler_class=EuslimeRequestHandler,
                  encoding='utf-8',
                  program='roseus',
                  loader='~/.euslime/slime-loader.l',
-                 color=False):
+                 color=False,
+                 workers=WORKERS,
+                 standby=0,
+                 standby_memory=None,
+                 flush_size=None,
+                 flush_interval=None,
+                 output_budget=None,
+                 output_spill=False,
+                 unix_socket=False,
+                 attach=None,
+                 record=None,
+                 multi_session=False,
+                 max_sessions=MAX_SESSIONS,
+                 session_memory=None,
+                 session_cpu=None,
+                 session_timeout=None,
+                 detach_timeout=None,
+                 detach_buffer=None,
+                 prestart=True):
+        self.start_time = time.time()
         log.info("Starting server with encoding {} and color {}".format(
             encoding, color))
         self.encoding = encoding
         self.program = program
         self.loader = loader
         self.color = color
+        self.workers = workers
+        self.standby = standby
+        self.standby_memory = standby_memory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.output_budget = output_budget
+        self.output_spill = output_spill
+        self.unix_socket = unix_socket
+        self.attach = attach
+        self.record = record
+        self.multi_session = multi_session
+        self.max_sessions = max_sessions if multi_session else 1
+        self.session_memory = session_memory
+        self.session_cpu = session_cpu
+        self.session_timeout = session_timeout
+        if detach_timeout and multi_session:
+            # Connections of all users may come from the same host,
+            # and none would tell whose session it reattaches to
+            log.warn("Sessions are not detachable with multi-session")
+            detach_timeout = None
+        self.detach_timeout = detach_timeout
+        self.detach_buffer = detach_buffer
+        self.session_counter = count(1)
+        self.sessions = set()
+        # Accepted connections, including those still starting
+        self.active = 0
+        self.lock = Lock()
+        self.prestarted = None
+        self.prestart_thread = None
+        self.repl_ready = False
 
         super(EuslimeServer, self).__init__(server_address, handler_class)
 
+        if prestart:
+            self.prestart_thread = Thread(target=self._prestart)
+            self.prestart_thread.daemon = True
+            self.prestart_thread.start()
+
         addr, port = self.server_address
+        if detach_timeout or \
+           multi_session and (session_timeout or session_memory):
+            t = Thread(target=self._reap_sessions)
+            t.daemon = True
+            t.start()
+
+    def new_protocol(self):
+        """Starts euslisp for a new session"""
+        return Protocol(EuslimeHandler, self.program, self.loader,
+                        encoding=ENCODINGS.get(self.encoding, 'utf-8'),
+                        color=self.color, standby=self.standby,
+                        standby_memory=self.standby_memory,
+                        flush_size=self.flush_size,
+                        flush_interval=self.flush_interval,
+                        output_budget=self.output_budget,
+                        output_spill=self.output_spill,
+                        unix_socket=self.unix_socket,
+                        cpu_limit=self.session_cpu,
+                        attach=self.attach)
+
+    def _prestart(self):
+        swank = None
+        try:
+            swank = self.new_protocol()
+            swank.handler.prepare()
+        except Exception:
+            log.error(traceback.format_exc())
+            if swank:
+                swank.handler.close()
+            return
+        self.prestarted = swank
+        log.info("Euslisp ready %.2f s after the server started" % (
+            time.time() - self.start_time))
+
+    def take_prestarted(self, timeout=None):
+        """Returns the session started with the server, once ready,
+        or None if it failed or was already taken"""
+        with self.lock:
+            thread, self.prestart_thread = self.prestart_thread, None
+        if thread is None:
+            return None
+        thread.join(timeout)
+        swank, self.prestarted = self.prestarted, None
+        if swank and not swank.handler.euslisp.running():
+            swank.handler.close()
+            return None
+        return swank
+
+    def repl_created(self):
+        with self.lock:
+            if self.repl_ready:
+                return
+            self.repl_ready = True
+        log.info("REPL ready %.2f s after the server started" % (
+            time.time() - self.start_time))
+        if euslime_stats.enabled:
+            euslime_stats.record('startup:repl', self.start_time)
+
+    def verify_request(self, request, client_address):
+        with self.lock:
+            running = self.active + len(self._detached())
+            if running >= self.max_sessions and not self._detached():
+                log.warn("Refusing connection from %s: %d sessions running" %
+                         (client_address[0], running))
+                return False
+            self.active += 1
+        return True
+
+    def _detached(self):
+        # Detached sessions, the most recently detached first
+        sessions = [h for h in self.sessions if h.detached_since is not None]
+        return sorted(sessions, key=lambda h: -h.detached_since)
+
+    def detach_session(self, handler):
+        with self.lock:
+            handler.detached_since = time.time()
+
+    def claim_detached(self, handler):
+        """Returns True if handler was detached, which it no longer is"""
+        with self.lock:
+            detached = handler.detached_since is not None
+            handler.detached_since = None
+        return detached
+
+    def reattach_session(self, client_address):
+        """Returns the detached session client_address takes over, if any"""
+        with self.lock:
+            sessions = self._detached()
+            if not sessions:
+                return None
+            sessions[0].detached_since = None
+            return sessions[0]
+
+    def finish_request(self, request, client_address):
+        try:
+            super(EuslimeServer, self).finish_request(request, client_address)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def add_session(self, handler):
+        with self.lock:
+            self.sessions.add(handler)
+        log.info("Session %d started for %s" % (
+            handler.session_id, handler.client_address[0]))
+
+    def remove_session(self, handler):
+        with self.lock:
+            self.sessions.discard(handler)
+
+    def record_path(self, session_id):
+        if not self.multi_session:
+            return self.record
+        # session.gz -> session-1.gz
+        root, ext = os.path.splitext(self.record)
+        return '{}-{}{}'.format(root, session_id, ext)
+
+    def _reap_sessions(self):
+        interval = min(REAP_INTERVAL, self.session_timeout or REAP_INTERVAL,
+                       self.detach_timeout or REAP_INTERVAL)
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                sessions = list(self.sessions)
+            # Only shared servers limit the sessions
+            timeout = memory = None
+            if self.multi_session:
+                timeout, memory = self.session_timeout, self.session_memory
+            for handler in sessions:
+                try:
+                    handler.check_limits(timeout, memory,
+                                         self.detach_timeout)
+                except Exception:
+                    log.error(traceback.format_exc())
+
+    def server_close(self):
+        swank = self.take_prestarted(DRAIN_TIMEOUT)
+        if swank:
+            swank.handler.close()
+        with self.lock:
+            sessions = list(self.sessions)
+        for handler in sessions:
+            handler.close_session('server is shutting down')
+            handler.swank.handler.close()
+        super(EuslimeServer, self).server_close()
 
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -116,12 +688,39 @@ class EuslimeServer(S.TCPServer, object):
 
 
 def serve(host='0.0.0.0', port=0, port_filename=str(), encoding='utf-8',
-          program='roseus', loader='~/.euslime/slime-loader.l', color=False):
+          program='roseus', loader='~/.euslime/slime-loader.l', color=False,
+          workers=WORKERS, standby=0, standby_memory=None,
+          flush_size=None, flush_interval=None, output_budget=None,
+          output_spill=False, unix_socket=False, attach=None,
+          stats=False, stats_file=str(), stats_interval=None,
+          record=None, multi_session=False, max_sessions=MAX_SESSIONS,
+          session_memory=None, session_cpu=None, session_timeout=None,
+          detach_timeout=None, detach_buffer=None, prestart=True):
+    if stats or stats_file:
+        euslime_stats.enable(stats_file, stats_interval)
     server = EuslimeServer((host, port),
                            encoding=encoding,
                            program=program,
                            loader=loader,
-                           color=color)
+                           color=color,
+                           workers=workers,
+                           standby=standby,
+                           standby_memory=standby_memory,
+                           flush_size=flush_size,
+                           flush_interval=flush_interval,
+                           output_budget=output_budget,
+                           output_spill=output_spill,
+                           unix_socket=unix_socket,
+                           attach=attach,
+                           record=record,
+                           multi_session=multi_session,
+                           max_sessions=max_sessions,
+                           session_memory=session_memory,
+                           session_cpu=session_cpu,
+                           session_timeout=session_timeout,
+                           detach_timeout=detach_timeout,
+                           detach_buffer=detach_buffer,
+                           prestart=prestart)
 
     host, port = server.socket.getsockname()
 
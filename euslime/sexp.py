@@ -0,0 +1,190 @@
+import re
+
+from sexpdata import Bracket, Quoted, String, Symbol
+
+from euslime.logger import get_logger
+
+log = get_logger(__name__)
+
+HEADER_FORMAT = '{0:06x}'
+BRACKETS = {'(': ')', '[': ']'}
+# Digits or signs at the start of a number
+NUMBER_START = frozenset('0123456789+-.')
+TOKENS = re.compile(r'''
+(?:\s+|;[^\n]*)*                            # whitespace and comments
+(?:([()\[\]'])                              # bracket or quote
+|("[^"\\]*(?:\\.[^"\\]*)*")                  # string
+|((?:[^\s()\[\]"'\\]|\\.)[^\s()\[\]"'\\]*(?:\\.[^\s()\[\]"'\\]*)*)  # atom
+|(.))                                        # anything else is an error
+''', re.S | re.X)
+ESCAPE = re.compile(r'\\.', re.S)
+STRING_ESCAPES = String._lisp_quoted_to_raw
+SYMBOL_ESCAPES = Symbol._lisp_quoted_to_raw
+SYMBOL_SPECIALS = Symbol._lisp_quoted_specials
+# Number of quoted symbol names kept
+SYMBOL_CACHE_SIZE = 4096
+# Marks a quote waiting for the next datum
+QUOTE = object()
+
+
+def _unescape(text, escapes):
+    # Unknown escapes are kept as is, as sexpdata does
+    return ESCAPE.sub(lambda m: escapes.get(m.group(), m.group()), text)
+
+
+def loads(string, nil='nil', true='t'):
+    """Reads the subset of s-expressions exchanged by SLIME and euslisp.
+
+    Same results as sexpdata.loads for lists, vectors, quotes, strings,
+    symbols, integers, floats, nil and t.
+    """
+    stack = []
+    sexp = []
+    for punct, text, atom, error in TOKENS.findall(string):
+        if atom:
+            if '\\' in atom:
+                atom = _unescape(atom, SYMBOL_ESCAPES)
+            val = _atom(atom, nil, true)
+        elif text:
+            val = text[1:-1]
+            if '\\' in val:
+                val = _unescape(val, STRING_ESCAPES)
+        elif punct in BRACKETS:
+            stack.append((sexp, punct))
+            sexp = []
+            continue
+        elif punct == "'":
+            sexp.append(QUOTE)
+            continue
+        elif punct:
+            if not stack or BRACKETS[stack[-1][1]] != punct:
+                raise ValueError('Unexpected {!r}'.format(punct))
+            val = sexp
+            sexp, bra = stack.pop()
+            if bra != '(':
+                val = Bracket(val, bra)
+        else:
+            raise ValueError('Invalid s-expression: {!r}'.format(
+                string[:80]))
+        while sexp and sexp[-1] is QUOTE:
+            sexp.pop()
+            val = Quoted(val)
+        sexp.append(val)
+    if stack:
+        raise ValueError('Missing closing bracket')
+    if len(sexp) != 1 or sexp[0] is QUOTE:
+        raise ValueError('Expected one s-expression, got {}'.format(
+            len(sexp)))
+    return sexp[0]
+
+
+def _atom(token, nil, true):
+    if token == nil:
+        return []
+    if token == true:
+        return True
+    if token[0] in NUMBER_START:
+        try:
+            return int(token)
+        except ValueError:
+            try:
+                return float(token)
+            except ValueError:
+                pass
+    return Symbol(token)
+
+
+class Encoder(object):
+    """Writes python objects as s-expressions in utf-8.
+
+    Strings are expected to be unicode or utf-8 encoded str, as euslisp
+    returns them, and are written without decoding. Only backslashes and
+    double quotes are escaped, which is enough for the emacs reader.
+    """
+
+    def __init__(self, none_as='nil'):
+        self.none_as = none_as
+        self.symbols = {}
+
+    def encode(self, obj):
+        parts = []
+        self._encode(obj, parts)
+        return ''.join(parts)
+
+    def _encode(self, obj, parts):
+        if isinstance(obj, (list, tuple)):
+            self._encode_list(obj, '(', parts)
+        elif isinstance(obj, str):
+            parts.append('"')
+            parts.append(obj.replace('\\', '\\\\').replace('"', '\\"'))
+            parts.append('"')
+        elif isinstance(obj, unicode):
+            self._encode(obj.encode('utf-8'), parts)
+        elif isinstance(obj, Symbol):
+            parts.append(self._symbol(obj.value()))
+        elif obj is True:
+            parts.append('t')
+        elif obj is None or obj is False:
+            parts.append(self.none_as)
+        elif isinstance(obj, (int, long, float)):
+            parts.append(str(obj))
+        elif isinstance(obj, dict):
+            self._encode([x for key, val in obj.items()
+                          for x in (Symbol(':' + key), val)], parts)
+        elif isinstance(obj, Quoted):
+            parts.append("'")
+            self._encode(obj.value(), parts)
+        elif isinstance(obj, Bracket):
+            self._encode_list(obj.value(), obj._bra, parts)
+        else:
+            raise TypeError("Cannot encode {!r}".format(obj))
+
+    def _encode_list(self, obj, bra, parts):
+        parts.append(bra)
+        first = True
+        for x in obj:
+            if not first:
+                parts.append(' ')
+            first = False
+            self._encode(x, parts)
+        parts.append(BRACKETS[bra])
+
+    def _symbol(self, name):
+        # A handful of symbols make up most messages
+        try:
+            return self.symbols[name]
+        except KeyError:
+            pass
+        quoted = name.encode('utf-8') if isinstance(name, unicode) else name
+        for s, q in SYMBOL_SPECIALS:
+            quoted = quoted.replace(s, q)
+        if len(self.symbols) < SYMBOL_CACHE_SIZE:
+            self.symbols[name] = quoted
+        return quoted
+
+
+_encoder = Encoder()
+
+
+def dumps(obj, none_as='nil'):
+    """Returns obj as an s-expression in a utf-8 encoded str"""
+    if none_as == 'nil':
+        return _encoder.encode(obj)
+    return Encoder(none_as).encode(obj)
+
+
+def encode_message(obj, encoding='utf-8'):
+    """Returns obj as a swank message, with its length header"""
+    payload = _encoder.encode(obj)
+    try:
+        text = payload.decode('utf-8')
+    except UnicodeDecodeError:
+        # For example in (apropos "default")
+        log.warn('UnicodeDecodeError at %s' % payload)
+        text = payload.decode('utf-8', 'ignore')
+        payload = None
+    if encoding != 'utf-8':
+        payload = text.encode(encoding, 'replace')
+    elif payload is None:
+        payload = text.encode('utf-8')
+    return HEADER_FORMAT.format(len(payload)) + payload
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from euslime.logger import get_logger
+
+log = get_logger(__name__)
+
+# Upper bounds of the histogram buckets in milliseconds, four per octave
+# from 10us to over 2 minutes, so that percentiles are within 19%
+BUCKETS = tuple(0.01 * 2 ** (i / 4.0) for i in range(96)) + (float('inf'),)
+DUMP_INTERVAL = 60
+
+# Instrumentation costs one check of this flag while disabled
+enabled = False
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram(object):
+    """Latencies of one operation, bucketed on a logarithmic scale.
+
+    Each sample may carry the part spent waiting for euslisp,
+    so that it can be told apart from the time spent in python.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.euslisp = 0.0
+        self.max = 0.0
+
+    def add(self, ms, euslisp_ms=0.0):
+        self.buckets[bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.euslisp += euslisp_ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile"""
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, num in zip(BUCKETS, self.buckets):
+            seen += num
+            if num and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        count = self.count or 1
+        return {
+            'count': self.count,
+            'mean_ms': self.total / count,
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max,
+            'euslisp_ms': self.euslisp / count,
+            'python_ms': (self.total - self.euslisp) / count,
+        }
+
+
+def enable(dump_file=None, interval=None):
+    """Starts collecting, and dumping to dump_file if given"""
+    global enabled
+    enabled = True
+    if dump_file:
+        t = threading.Thread(target=_dump_loop,
+                             args=(dump_file, interval or DUMP_INTERVAL))
+        t.daemon = True
+        t.start()
+
+
+def clock():
+    """Returns the time to pass to the recording functions"""
+    if enabled:
+        return time.time()
+
+
+def begin_request():
+    # Waits for euslisp are summed per thread, as requests are
+    # handled by one worker thread each
+    if enabled:
+        _local.euslisp = 0.0
+        return time.time()
+
+
+def end_request(name, start):
+    if start is not None:
+        euslisp = getattr(_local, 'euslisp', 0.0)
+        record(name, start, euslisp)
+
+
+def waited(start):
+    """Counts the time since start as spent waiting for euslisp"""
+    if start is not None:
+        _local.euslisp = getattr(_local, 'euslisp', 0.0) + \
+            time.time() - start
+
+
+def record(name, start, euslisp=None):
+    if start is None:
+        return
+    ms = (time.time() - start) * 1e3
+    euslisp_ms = ms if euslisp is None else euslisp * 1e3
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.add(ms, euslisp_ms)
+
+
+def count(name):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + 1
+
+
+def snapshot():
+    with _lock:
+        return {
+            'requests': dict((name, hist.summary())
+                             for name, hist in _histograms.items()),
+            'counters': dict(_counters),
+        }
+
+
+def dump(path):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _dump_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            dump(path)
+        except (IOError, OSError) as e:
+            log.warn("Failed to dump statistics: %s" % e)
@@ -110,6 +110,33 @@
         (setq-local slime-complete-symbol-function
           (buffer-local-value 'slime-complete-symbol-function buf)))))
 
+;; SHOW STATISTICS
+(defun slime-euslisp-stats ()
+  "Display the request latency statistics collected by euslime."
+  (interactive)
+  (let ((stats (slime-eval '(swank:euslime-stats))))
+    (if (null stats)
+        (message "Statistics are not enabled, start euslime with --stats")
+      (with-current-buffer (get-buffer-create "*euslime-stats*")
+        (special-mode)
+        (let ((inhibit-read-only t))
+          (erase-buffer)
+          (insert (format "%-32s %8s %9s %9s %9s %9s %9s %9s\n"
+                          "request (ms)" "count" "mean" "p50" "p99" "max"
+                          "euslisp" "python"))
+          (dolist (entry (plist-get stats :requests))
+            (insert (apply #'format
+                           "%-32s %8d %9.2f %9.2f %9.2f %9.2f %9.2f %9.2f\n"
+                           (car entry)
+                           (mapcar (lambda (key) (plist-get (cdr entry) key))
+                                   '(:count :mean-ms :p50-ms :p99-ms :max-ms
+                                     :euslisp-ms :python-ms)))))
+          (insert "\n")
+          (dolist (counter (plist-get stats :counters))
+            (insert (format "%-32s %8d\n" (car counter) (cadr counter)))))
+        (goto-char (point-min))
+        (display-buffer (current-buffer))))))
+
 ;; DEFINE MINOR MODE
 (defun slime-euslisp--doc-map-prefix ()
   (concat